@@ -2,15 +2,18 @@
 ## CircuitPython code for a basic clock on TFT display
 ##
 
+import time
+import errno
+import struct
 import asyncio
 import board
+import rtc
 import keypad
 import adafruit_logging as logging
 import traceback
 
 import wifi
 import socketpool
-import adafruit_ntp
 import adafruit_connection_manager
 import adafruit_requests
 
@@ -28,6 +31,20 @@ TZ_OFFSET = 0 ## use AF service to get offset
 #TZ_OFFSET = -7 # for PDT
 #TZ_OFFSET = -8 # for PST
 
+# the clock runs locally from rtc/monotonic time, and only goes to the NTP
+# server every NTP_RESYNC_INTVL seconds (in a background task), correcting
+# for the crystal drift measured between syncs
+NTP_RESYNC_INTVL = 6 * 3600
+NTP_RETRY_INTVL = 60
+NTP_SERVERS = ('0.adafruit.pool.ntp.org', '1.adafruit.pool.ntp.org',
+               '2.adafruit.pool.ntp.org', '3.adafruit.pool.ntp.org')
+# wait this long for an NTP reply (the render task keeps running meanwhile,
+# polling the socket every NTP_POLL secs)
+NTP_TIMEOUT = 1
+NTP_POLL = 0.02
+# don't trust a drift estimate from syncs closer together than this
+MIN_DRIFT_SPAN = 600
+
 LARGE_FONT =  "fonts/DejaVuSans-Bold-36.pcf"
 FG_COLORS = [0x0000FF, 0xFF00FF, 0xFF0000, 0xFFFF00, 0x00FF00, 0x00FFFF]
 
@@ -38,6 +55,18 @@ FG_COLORS = [0x0000FF, 0xFF00FF, 0xFF0000, 0xFFFF00, 0x00FF00, 0x00FFFF]
 #BUTTON_UP = board.D0
 BUTTON_UP = board.D1
 BUTTON_DOWN = board.D2
+# keypad scans and queues events in the background, so checking the queue
+# this often loses nothing and lets the CPU idle in between
+BUTTON_POLL = 0.05
+# holding a button auto-repeats after LONG_PRESS secs, starting at
+# REPEAT_START secs per step and speeding up by REPEAT_ACCEL to REPEAT_MIN
+LONG_PRESS = 0.5
+REPEAT_START = 0.3
+REPEAT_ACCEL = 0.7
+REPEAT_MIN = 0.05
+
+# log the CPU idle percentage this often (secs)
+IDLE_REPORT_INTVL = 60
 
 
 class ColorSelect():
@@ -54,6 +83,25 @@ class ColorSelect():
         self.color_wheel = [self.color_wheel[-1]] + self.color_wheel[0:-1]
 
 
+class CpuMeter:
+    """Tracks how much of the wall-clock time the tasks spend working"""
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.start_ns = time.monotonic_ns()
+        self.busy_ns = 0
+
+    def add(self, busy_ns):
+        self.busy_ns += busy_ns
+
+    def idle_pct(self):
+        total_ns = time.monotonic_ns() - self.start_ns
+        if total_ns <= 0:
+            return 100.0
+        return 100.0 - 100.0 * self.busy_ns / total_ns
+
+
 def get_time_string(ts):
     return f'{ts.tm_hour:02d}:{ts.tm_min:02d}:{ts.tm_sec:02d}'
 
@@ -96,10 +144,136 @@ def get_ntp_handle(*, dhcpname=None, tz_offset=0):
             tz_offset = int(val)
 
     # NTP handle
-    ntp = adafruit_ntp.NTP(pool, tz_offset=tz_offset, cache_seconds=600)
-          # default server = "0.adafruit.pool.ntp.org"
-          # cache_seconds = poll NTP no more often than (what is optimal?)
-    return ntp
+    return NtpClient(pool, tz_offset=tz_offset)
+
+
+class NtpClient:
+    """SNTP queries that don't block the event loop: the request goes out on
+    a non-blocking UDP socket, which is polled with asyncio.sleep() until
+    the reply comes (instead of adafruit_ntp's blocking recv_into).  Only
+    the DNS lookup of NTP_SERVERS blocks: it's done by the first query (at
+    startup, before the clock is drawn), and again only after every address
+    it gave has failed; the resyncs in between reuse them."""
+    NTP_TO_UNIX_EPOCH = 2_208_988_800  # 1970-01-01 00:00:00
+    PACKET_SIZE = 48
+
+    def __init__(self, pool, *, servers=NTP_SERVERS, port=123, tz_offset=0):
+        self.pool = pool
+        self.servers = servers
+        self.port = port
+        self.tz_offset_ns = int(tz_offset * 3600) * 1_000_000_000
+        self.packet = bytearray(self.PACKET_SIZE)
+        self.addresses = []
+
+    def _resolve(self):
+        if self.addresses:
+            return
+        for name in self.servers:
+            try:
+                address = self.pool.getaddrinfo(name, self.port)[0][4]
+            except OSError:
+                continue
+            if address not in self.addresses:
+                self.addresses.append(address)
+        if not self.addresses:
+            raise OSError('NTP: could not resolve any server')
+
+    def _to_ns(self, offset):
+        secs, frac = struct.unpack_from('!II', self.packet, offset)
+        if secs < self.NTP_TO_UNIX_EPOCH:
+            # a zeroed or truncated field, not a real time
+            raise ArithmeticError('NTP response has an invalid timestamp')
+        return ((secs - self.NTP_TO_UNIX_EPOCH) * 1_000_000_000 +
+                frac * 1_000_000_000 // 2**32)
+
+    async def _query(self, address):
+        packet = self.packet
+        packet[0] = 0b00100011  # not leap second, NTP version 4, client mode
+        for i in range(1, self.PACKET_SIZE):
+            packet[i] = 0
+        with self.pool.socket(self.pool.AF_INET, self.pool.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            send_ns = time.monotonic_ns()
+            sock.sendto(packet, address)
+            deadline = send_ns + int(NTP_TIMEOUT * 1_000_000_000)
+            while True:
+                try:
+                    received = sock.recv_into(packet)
+                    break
+                except OSError as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+                if time.monotonic_ns() >= deadline:
+                    raise OSError(errno.ETIMEDOUT, 'NTP: no reply')
+                await asyncio.sleep(NTP_POLL)
+            recv_ns = time.monotonic_ns()
+        if received < self.PACKET_SIZE:
+            raise ArithmeticError(f'NTP response was {received} bytes')
+        # offset of the server's UTC from monotonic_ns (the midpoint of
+        # the two legs of the exchange), like adafruit_ntp
+        offset = ((self._to_ns(32) - send_ns) +
+                  (self._to_ns(40) - recv_ns)) // 2
+        return recv_ns, recv_ns + offset + self.tz_offset_ns
+
+    async def local_ns(self):
+        """(monotonic_ns, local time in ns at that instant) from the first
+        server that replies.  Raises OSError if none does, ArithmeticError
+        for a bogus reply."""
+        self._resolve()
+        error = None
+        for _ in range(len(self.addresses)):
+            try:
+                return await self._query(self.addresses[0])
+            except (OSError, ArithmeticError) as e:
+                error = e
+            # try the next server, this one goes to the back
+            self.addresses.append(self.addresses.pop(0))
+        # none replied: look the servers up again next time (the pool may
+        # have moved on)
+        self.addresses = []
+        raise error
+
+
+class TimeService:
+    """Local clock: set rtc.RTC() from NTP once in a while, and extrapolate
+    from time.monotonic_ns() in between, corrected for the measured drift.
+    Only sync() touches the network (awaiting, not blocking, for the reply;
+    see NtpClient for the DNS lookup)."""
+    def __init__(self, ntp):
+        self.ntp = ntp
+        self.rtc = rtc.RTC()
+        # (monotonic_ns, NTP local time in ns) at the last sync
+        self.last_sync = None
+        # how fast our clock runs slow (+) or fast (-), in parts per billion
+        self.drift_ppb = 0
+
+    async def sync(self):
+        """Query NTP (may raise OSError or ArithmeticError), reset the RTC
+        and update the drift estimate"""
+        mono, ntp_ns = await self.ntp.local_ns()
+        if self.last_sync:
+            last_mono, last_ntp = self.last_sync
+            local = mono - last_mono
+            if local >= MIN_DRIFT_SPAN * 1_000_000_000:
+                true = ntp_ns - last_ntp
+                self.drift_ppb = (true - local) * 1_000_000_000 // local
+        self.last_sync = (mono, ntp_ns)
+        self.rtc.datetime = time.localtime(ntp_ns // 1_000_000_000)
+
+    def now_ns(self):
+        if not self.last_sync:
+            return int(time.time()) * 1_000_000_000
+        last_mono, last_ntp = self.last_sync
+        elapsed = time.monotonic_ns() - last_mono
+        return last_ntp + elapsed + elapsed * self.drift_ppb // 1_000_000_000
+
+    def now(self):
+        return time.localtime(self.now_ns() // 1_000_000_000)
+
+    def until_next_second(self, margin_ms=20):
+        """Seconds to sleep to wake just after the next second boundary"""
+        ns = 1_000_000_000 - self.now_ns() % 1_000_000_000
+        return (ns + margin_ms * 1_000_000) / 1_000_000_000
 
 
 class MyDisplay:
@@ -130,53 +304,105 @@ class MyDisplay:
         # logger.debug(f'update_text with {text} and color {fgcolor:x}')
 
 
-async def handle_buttons(pin_up, pin_down, color_wheel):
-    """Handle two buttons: up/down run through a set of FG colors."""
+def rotate_colors(color_wheel, key_number):
     logger = logging.getLogger('main')
+    if key_number == 0:
+        # rotate up
+        color_wheel.rotate_left()
+        fgcolor = color_wheel.get()
+        logger.info(f'key UP - rotate left - color {fgcolor:x}')
+    else:
+        # key_number == 1
+        color_wheel.rotate_right()
+        fgcolor = color_wheel.get()
+        logger.info(f'key DOWN - rotate right - color {fgcolor:x}')
+
+
+async def handle_buttons(pin_up, pin_down, color_wheel, meter):
+    """Handle two buttons: up/down run through a set of FG colors.
+    Holding a button keeps rotating, faster the longer it's held."""
+    event = keypad.Event()
+    held = None
+    next_repeat = 0
+    repeat = REPEAT_START
     with keypad.Keys(
         (pin_down, pin_up), value_when_pressed=True, pull=True
     ) as keys:
         while True:
-            event = keys.events.get()
-            if event and event.pressed:
-                if event.key_number == 0:
-                    # rotate up
-                    color_wheel.rotate_left()
-                    fgcolor = color_wheel.get()
-                    logger.info(f'key UP - rotate left - color {fgcolor:x}')
-                else:
-                    # key_number == 1
-                    color_wheel.rotate_right()
-                    fgcolor = color_wheel.get()
-                    logger.info(f'key DOWN - rotate left - color {fgcolor:x}')
-            # Let another task run.
-            await asyncio.sleep(0)
+            now = time.monotonic()
+            t0 = time.monotonic_ns()
+            # get_into() reuses one Event, no allocation per poll
+            while keys.events.get_into(event):
+                if event.pressed:
+                    rotate_colors(color_wheel, event.key_number)
+                    held = event.key_number
+                    next_repeat = now + LONG_PRESS
+                    repeat = REPEAT_START
+                elif event.key_number == held:
+                    held = None
+            if held is not None and now >= next_repeat:
+                rotate_colors(color_wheel, held)
+                next_repeat = now + repeat
+                repeat = max(repeat * REPEAT_ACCEL, REPEAT_MIN)
+            meter.add(time.monotonic_ns() - t0)
+            # sleep (not just yield) so the CPU can idle between polls
+            await asyncio.sleep(BUTTON_POLL)
+
+
+async def keep_time(time_svc):
+    """Resync the clock from NTP in the background"""
+    logger = logging.getLogger('main')
+    while True:
+        if time_svc.last_sync:
+            await asyncio.sleep(NTP_RESYNC_INTVL)
+        while True:
+            try:
+                await time_svc.sync()
+                logger.info(f'NTP resync, drift {time_svc.drift_ppb} ppb')
+                break
+            except (OSError, ArithmeticError) as e:
+                # prob a timeout to NTP server (or a bad reply), try again
+                # later
+                logger.error(f'NTP error: {e}')
+                await asyncio.sleep(NTP_RETRY_INTVL)
 
 
 ## main program
 async def main():
     logger = logging.getLogger('main')
     ntp_hndl = get_ntp_handle(dhcpname='esp32clock')
+    time_svc = TimeService(ntp_hndl)
+    try:
+        await time_svc.sync()
+    except (OSError, ArithmeticError) as e:
+        # run from the RTC until the background task gets a sync
+        logger.error(f'NTP error: {e}')
     color_wheel = ColorSelect()
     disp = MyDisplay(board.DISPLAY, LARGE_FONT, color_wheel)
 
+    meter = CpuMeter()
     button_task = asyncio.create_task(
-        handle_buttons(BUTTON_UP, BUTTON_DOWN, color_wheel)
+        handle_buttons(BUTTON_UP, BUTTON_DOWN, color_wheel, meter)
     )
+    clock_task = asyncio.create_task(keep_time(time_svc))
 
+    last_report = time.monotonic()
     while True:
         try:
-            #now = time.localtime()
-            now = ntp_hndl.datetime
+            t0 = time.monotonic_ns()
+            # local clock only, never waits on the network
+            now = time_svc.now()
             time_text = get_time_string(now)
             logger.debug(f'Time = {time_text}')
             disp.update_text(time_text)
-            await asyncio.sleep(1)
+            meter.add(time.monotonic_ns() - t0)
+
+            if time.monotonic() - last_report >= IDLE_REPORT_INTVL:
+                logger.info(f'CPU idle: {meter.idle_pct():.1f}%')
+                meter.reset()
+                last_report = time.monotonic()
 
-        except OSError as e:
-            # NTP error
-            logger.error(f'OSError: {e}')
-            # prob a timeout to NTP server, just try again
+            await asyncio.sleep(time_svc.until_next_second())
 
         except Exception as e:
             # This works to print a stack trace
@@ -185,7 +411,7 @@ async def main():
             # re-raise the error and hang the program
             raise
 
-    await asyncio.gather(button_task)
+    await asyncio.gather(button_task, clock_task)
 
 
 ## actual exec here:
@@ -15,6 +15,7 @@ import adafruit_ntp
 #from adafruit_display_text.bitmap_label import Label
 
 import displayio
+import bitmaptools
 from adafruit_display_shapes.rect import Rect
 from adafruit_display_shapes.circle import Circle
 from adafruit_display_shapes.triangle import Triangle
@@ -29,26 +30,88 @@ FG_COLOR = 0x0000FF
 #FG_COLOR = 0x00ebf2
 #FG_COLOR = 0xFF0000
 
+# draw the digits from a pre-rendered sprite sheet (one TileGrid per digit)
+# instead of a Rect + 2 Triangles per segment
+SPRITE_DIGITS = True
+
+# wake up this long after each second boundary, so the new second is
+# always there when we look (and we don't render the old one twice)
+TICK_MARGIN_MS = 20
+# ask the NTP server again only this often: in between, utc_ns is worked
+# out from the local monotonic clock (no network round trip every tick)
+NTP_CACHE_SECONDS = 3600
+# warn when drawing+refreshing one tick takes longer than this
+RENDER_BUDGET_MS = 100
+DEBUG = False
+
 
 ## the LilyGo T-Display S3 board has a 320x170 screen
 ## the Feather S2 Reverse-TFT has 240x135
 
 
+SEGMENT_MAP = [
+    # vectors represent the segments [A,B,C,D,E,F,G]
+    [1,1,1,1,1,1,0], # 0
+    [0,1,1,0,0,0,0], # 1
+    [1,1,0,1,1,0,1], # 2
+    [1,1,1,1,0,0,1], # 3
+    [0,1,1,0,0,1,1], # 4
+    [1,0,1,1,0,1,1], # 5
+    [1,0,1,1,1,1,1], # 6
+    [1,1,1,0,0,0,0], # 7
+    [1,1,1,1,1,1,1], # 8
+    [1,1,1,1,0,1,1], # 9
+]
+
+SEGW = 6
+WD = int(SEGW/2)
+
+
+def segment_rect(i, size):
+    """Rect [x, y, w, h] for the body of segment i (A-G) in a digit"""
+    width, height = size
+    if i == 0:
+        r = [SEGW+1, 0, width-2*SEGW-2, SEGW]
+    elif i == 1:
+        r = [width-SEGW, SEGW+1, SEGW, height/2-1.5*SEGW-2]
+    elif i == 2:
+        r = [width-SEGW, (height+SEGW)/2+1, SEGW, height/2-1.5*SEGW-2]
+    elif i == 3:
+        r = [SEGW+1, height-SEGW, width-2*SEGW-2, SEGW]
+    elif i == 4:
+        r = [0, (height+SEGW)/2+1, SEGW, height/2-1.5*SEGW-2]
+    elif i == 5:
+        r = [0, SEGW+1, SEGW, height/2-1.5*SEGW-2]
+    elif i == 6:
+        r = [SEGW+1, (height-SEGW)/2, width-2*SEGW-2, SEGW]
+    return [int(x) for x in r]
+
+
+def segment_tips(i, r):
+    """The two triangles that make the pointed ends of segment i"""
+    if i in [0, 3, 6]:
+        # horizontal
+        pts_l = [(r[0]-WD, r[1]+WD),
+                 (r[0], r[1]),
+                 (r[0], r[1]+r[3])]
+        pts_r = [(r[0]+r[2]+WD, r[1]+WD),
+                 (r[0]+r[2], r[1]),
+                 (r[0]+r[2], r[1]+r[3])]
+        return pts_l, pts_r
+    else:
+        # vertical
+        pts_u = [(r[0]+WD, r[1]-WD),
+                 (r[0], r[1]),
+                 (r[0]+r[2], r[1])]
+        pts_l = [(r[0]+WD, r[1]+r[3]+WD),
+                 (r[0], r[1]+r[3]),
+                 (r[0]+r[2], r[1]+r[3])]
+        return pts_u, pts_l
+
+
 class DigitDisplay:
     """Wrapper for GPIO pins driving 7-segment LED digit display."""
-    SEGMENT_MAP = [
-        # vectors represent the segments [A,B,C,D,E,F,G]
-        [1,1,1,1,1,1,0], # 0
-        [0,1,1,0,0,0,0], # 1
-        [1,1,0,1,1,0,1], # 2
-        [1,1,1,1,0,0,1], # 3
-        [0,1,1,0,0,1,1], # 4
-        [1,0,1,1,0,1,1], # 5
-        [1,0,1,1,1,1,1], # 6
-        [1,1,1,0,0,0,0], # 7
-        [1,1,1,1,1,1,1], # 8
-        [1,1,1,1,0,1,1], # 9
-    ]
+    SEGMENT_MAP = SEGMENT_MAP
 
     def __init__(self, group, size, bgcolor, **kwargs):
         super().__init__(**kwargs)
@@ -75,9 +138,6 @@ class DigitDisplay:
         self.root_group.insert(0, bg_sprite)
 
     def draw_digit(self, digit, fgcolor="white"):
-        width, height = self.size
-        SEGW = 6
-        WD = int(SEGW/2)
         # clear out old surface ??
         #self.fill_bg(self.bg)
         segments = self.get_segments(digit)
@@ -89,73 +149,81 @@ class DigitDisplay:
                 if on:
                     g = displayio.Group()
                     self.segm_map[i] = g
-                    if i == 0:
-                        r = [SEGW+1, 0, width-2*SEGW-2, SEGW]
-                    elif i == 1:
-                        r = [width-SEGW, SEGW+1, SEGW, height/2-1.5*SEGW-2]
-                    elif i == 2:
-                        r = [width-SEGW, (height+SEGW)/2+1, SEGW, height/2-1.5*SEGW-2]
-                    elif i == 3:
-                        r = [SEGW+1, height-SEGW, width-2*SEGW-2, SEGW]
-                    elif i == 4:
-                        r = [0, (height+SEGW)/2+1, SEGW, height/2-1.5*SEGW-2]
-                    elif i == 5:
-                        r = [0, SEGW+1, SEGW, height/2-1.5*SEGW-2]
-                    elif i == 6:
-                        r = [SEGW+1, (height-SEGW)/2, width-2*SEGW-2, SEGW]
-                        
-                    try:
-                        r = [int(x) for x in r]
-                        rect = Rect(r[0], r[1], r[2], r[3], fill=fgcolor)
-                        g.append(rect)
-                    except TypeError as e:
-                        print(e)
-                        print(f'EXCEPT1: i={i} r= {r[0]}, {r[1]}, {r[2]}, {r[3]} fill={fgcolor}')
-
-                    if True:
-                        if i in [0, 3, 6]:
-                            # horizontal
-                            try:
-                                pts_l = [(r[0]-WD, r[1]+WD),
-                                         (r[0], r[1]),
-                                         (r[0], r[1]+r[3])]
-                                pts_r = [(r[0]+r[2]+WD, r[1]+WD),
-                                         (r[0]+r[2], r[1]),
-                                         (r[0]+r[2], r[1]+r[3])]
-                                tri1 = Triangle(pts_l[0][0], pts_l[0][1], 
-                                                pts_l[1][0], pts_l[1][1], 
-                                                pts_l[2][0], pts_l[2][1], fill=fgcolor)
-                                g.append(tri1)
-                                tri2 = Triangle(pts_r[0][0], pts_r[0][1], 
-                                                pts_r[1][0], pts_r[1][1], 
-                                                pts_r[2][0], pts_r[2][1], fill=fgcolor)
-                                g.append(tri2)
-                            except TypeError as e:
-                                print(e)
-                                print(f'EXCEPT2: i={i} r= {r[0]}, {r[1]}, {r[2]}, {r[3]} fill={fgcolor}')
-                                print('EXCEPT2:', pts_l)
-                        else:
-                            # vertical
-                            pts_u = [(r[0]+WD, r[1]-WD),
-                                     (r[0], r[1]),
-                                     (r[0]+r[2], r[1])]
-                            pts_l = [(r[0]+WD, r[1]+r[3]+WD),
-                                     (r[0], r[1]+r[3]),
-                                     (r[0]+r[2], r[1]+r[3])]
-                            tri1 = Triangle(pts_u[0][0], pts_u[0][1], 
-                                            pts_u[1][0], pts_u[1][1], 
-                                            pts_u[2][0], pts_u[2][1], fill=fgcolor)
-                            g.append(tri1)
-                            tri2 = Triangle(pts_l[0][0], pts_l[0][1], 
-                                            pts_l[1][0], pts_l[1][1], 
-                                            pts_l[2][0], pts_l[2][1], fill=fgcolor)
-                            g.append(tri2)
+                    r = segment_rect(i, self.size)
+                    rect = Rect(r[0], r[1], r[2], r[3], fill=fgcolor)
+                    g.append(rect)
+
+                    for pts in segment_tips(i, r):
+                        tri = Triangle(pts[0][0], pts[0][1], 
+                                       pts[1][0], pts[1][1], 
+                                       pts[2][0], pts[2][1], fill=fgcolor)
+                        g.append(tri)
                     self.root_group.append(g)
                     g.hidden = False
 
         return self.root_group
 
 
+def _in_triangle(x, y, pts):
+    # same sign for all three edge functions -> inside (or on an edge)
+    d = []
+    for j in range(3):
+        (x0, y0), (x1, y1) = pts[j], pts[(j+1) % 3]
+        d.append((x1-x0)*(y-y0) - (y1-y0)*(x-x0))
+    return min(d) >= 0 or max(d) <= 0
+
+
+def make_digit_sheet(size):
+    """Pre-render the glyphs 0-9 side by side into one 2-color Bitmap"""
+    width, height = size
+    sheet = displayio.Bitmap(10*width, height, 2)
+    for digit, segments in enumerate(SEGMENT_MAP):
+        x0 = digit * width
+        for i, on in enumerate(segments):
+            if not on:
+                continue
+            r = segment_rect(i, size)
+            bitmaptools.fill_region(sheet, x0+r[0], r[1],
+                                    x0+r[0]+r[2], r[1]+r[3], 1)
+            for pts in segment_tips(i, r):
+                xs = [p[0] for p in pts]
+                ys = [p[1] for p in pts]
+                for y in range(max(min(ys), 0), min(max(ys)+1, height)):
+                    for x in range(max(min(xs), 0), min(max(xs)+1, width)):
+                        if _in_triangle(x, y, pts):
+                            sheet[x0+x, y] = 1
+    return sheet
+
+
+class SpriteDigitDisplay:
+    """Same interface as DigitDisplay, but each digit is a single tile of a
+    shared sprite sheet: changing the digit just changes the tile index."""
+    _sheets = {}
+
+    def __init__(self, group, size, bgcolor, fgcolor, **kwargs):
+        super().__init__(**kwargs)
+        self.root_group = group
+        self.size = size
+        # all digits of the same size and colors share one sheet
+        key = (size, bgcolor, fgcolor)
+        if key not in self._sheets:
+            palette = displayio.Palette(2)
+            palette[0] = bgcolor
+            palette[1] = fgcolor
+            self._sheets[key] = (make_digit_sheet(size), palette)
+        sheet, palette = self._sheets[key]
+        self.tile = displayio.TileGrid(sheet, pixel_shader=palette,
+                                       tile_width=size[0], tile_height=size[1])
+        self.root_group.append(self.tile)
+
+    def draw_digit(self, digit, fgcolor=None):
+        # fgcolor is baked into the sheet, it's only here to match DigitDisplay
+        assert (digit >= 0) and (digit < 10)
+        if self.tile[0] != digit:
+            self.tile[0] = digit
+        return self.root_group
+
+
 def get_time_string(ts):
     return f'{ts.tm_hour:02d}:{ts.tm_min:02d}:{ts.tm_sec:02d}'
     #return f'{ts.tm_hour:02d}:{ts.tm_min:02d}'
@@ -163,68 +231,121 @@ def get_time_string(ts):
 
 
 ## Network setup and ntp object
-# Get wifi details and more from a secrets.py file
-try:
-    from secrets import secrets
-except ImportError:
-    print("WiFi secrets are kept in secrets.py, please add them there!")
-    raise
-
-wifi.radio.connect(secrets["ssid"], secrets["password"])
-pool = socketpool.SocketPool(wifi.radio)
-ntp = adafruit_ntp.NTP(pool, tz_offset=TZ_OFFSET, socket_timeout=30)
-      # default server = "0.adafruit.pool.ntp.org"
-
-
-display = board.DISPLAY
-time_text = '00:00:00'
-digit_size = (35, 70)
-
-# display.show() is now replaced by setting .root_group
-display.root_group = displayio.Group()
-
-## set up the display tree
-digit_disps = [DigitDisplay(displayio.Group(), digit_size, BG_COLOR) 
-               for i in range(6)]
-positions = [10, 55, 120, 165, 230, 275]
-for x,dsp in zip(positions, digit_disps):
-    g = dsp.draw_digit(0, FG_COLOR)
-    g.x = x
-    g.y = 50
-    display.root_group.append(g)
-
-dot1 = Circle(105, 75, 3, fill=FG_COLOR)
-dot2 = Circle(105, 95, 3, fill=FG_COLOR)
-display.root_group.append(dot1)
-display.root_group.append(dot2)
-
-dot1 = Circle(215, 75, 3, fill=FG_COLOR)
-dot2 = Circle(215, 95, 3, fill=FG_COLOR)
-display.root_group.append(dot1)
-display.root_group.append(dot2)
-
-# pad = 10
-# r = Rectangle (pad, pad, self.WIDTH-2*pad, self.HEIGHT-2*pad, outline=FG_COLOR)
-# display.root_group.append(r)
-
-
-while True:
+def get_ntp_handle():
+    # Get wifi details and more from a secrets.py file
     try:
-        #now = time.localtime()
-        now = ntp.datetime
-
-        time_text = get_time_string(now)
-        #print('Time = ', time_text)
-
-        digits = time_text.replace(':', '')
-        #print('DBG: digits=', digits)
-        assert len(digits) == 6
-
-        for i,d in enumerate(digits):
+        from secrets import secrets
+    except ImportError:
+        print("WiFi secrets are kept in secrets.py, please add them there!")
+        raise
+
+    wifi.radio.connect(secrets["ssid"], secrets["password"])
+    pool = socketpool.SocketPool(wifi.radio)
+    ntp = adafruit_ntp.NTP(pool, tz_offset=TZ_OFFSET, socket_timeout=30,
+                           cache_seconds=NTP_CACHE_SECONDS)
+          # default server = "0.adafruit.pool.ntp.org"
+    return ntp
+
+
+def build_display(display):
+    """Set up the display tree: six digits plus the colons between them"""
+    digit_size = (35, 70)
+
+    # display.show() is now replaced by setting .root_group
+    display.root_group = displayio.Group()
+
+    ## set up the display tree
+    if SPRITE_DIGITS:
+        digit_disps = [SpriteDigitDisplay(displayio.Group(), digit_size,
+                                          BG_COLOR, FG_COLOR)
+                       for i in range(6)]
+    else:
+        digit_disps = [DigitDisplay(displayio.Group(), digit_size, BG_COLOR) 
+                       for i in range(6)]
+    positions = [10, 55, 120, 165, 230, 275]
+    for x,dsp in zip(positions, digit_disps):
+        g = dsp.draw_digit(0, FG_COLOR)
+        g.x = x
+        g.y = 50
+        display.root_group.append(g)
+
+    dot1 = Circle(105, 75, 3, fill=FG_COLOR)
+    dot2 = Circle(105, 95, 3, fill=FG_COLOR)
+    display.root_group.append(dot1)
+    display.root_group.append(dot2)
+
+    dot1 = Circle(215, 75, 3, fill=FG_COLOR)
+    dot2 = Circle(215, 95, 3, fill=FG_COLOR)
+    display.root_group.append(dot1)
+    display.root_group.append(dot2)
+
+    # pad = 10
+    # r = Rectangle (pad, pad, self.WIDTH-2*pad, self.HEIGHT-2*pad, outline=FG_COLOR)
+    # display.root_group.append(r)
+    return digit_disps
+
+
+def show_time(digit_disps, now, shown=''):
+    """Draw the digits of now that differ from the ones in shown, and
+    return the new digits"""
+    time_text = get_time_string(now)
+    #print('Time = ', time_text)
+
+    digits = time_text.replace(':', '')
+    #print('DBG: digits=', digits)
+    assert len(digits) == 6
+
+    for i,d in enumerate(digits):
+        if i >= len(shown) or shown[i] != d:
             digit_disps[i].draw_digit(int(d), FG_COLOR)
-
-    except OSError as e:
-        print('EXCEPTION:', e)
-
-    display.refresh()
-    time.sleep(1)
+    return digits
+
+
+def main():
+    ntp = get_ntp_handle()
+    display = board.DISPLAY
+    # only refresh when we changed something (not at 60Hz in the background)
+    display.auto_refresh = False
+    digit_disps = build_display(display)
+
+    shown = ''
+    max_render_ns = 0
+    while True:
+        delay_ns = 1_000_000_000
+        try:
+            #now = time.localtime()
+            # (utc_ns has the tz_offset applied, same as ntp.datetime)
+            now_ns = ntp.utc_ns
+            # (when now_ns was read, to take what the tick costs off the sleep)
+            t0 = time.monotonic_ns()
+            now = time.localtime(now_ns // 1_000_000_000)
+
+            digits = show_time(digit_disps, now, shown)
+            if digits != shown:
+                display.refresh()
+                shown = digits
+            render_ns = time.monotonic_ns() - t0
+
+            max_render_ns = max(max_render_ns, render_ns)
+            if render_ns > RENDER_BUDGET_MS * 1_000_000:
+                print(f'slow tick: {render_ns // 1000} us')
+            if DEBUG and now.tm_sec == 0:
+                print(f'max render/min: {max_render_ns // 1000} us')
+                max_render_ns = 0
+
+            # schedule the next tick just after the next second boundary,
+            # from the clock itself so that we don't drift, less the time
+            # spent since we read it
+            delay_ns = ( 1_000_000_000 - now_ns % 1_000_000_000 +
+                         TICK_MARGIN_MS * 1_000_000 -
+                         (time.monotonic_ns() - t0) )
+
+        except OSError as e:
+            print('EXCEPTION:', e)
+
+        time.sleep(max(delay_ns, 0) / 1_000_000_000)
+
+
+## actual exec here:
+if __name__ == '__main__':
+    main()
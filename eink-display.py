@@ -5,12 +5,16 @@
 
 import time
 import json
+import random
+import asyncio
 import adafruit_logging as logging
 import traceback
 
+import rtc
 import wifi
 import ssl
 import socketpool
+import adafruit_requests
 
 from adafruit_bitmap_font import bitmap_font
 from adafruit_display_text.bitmap_label import Label
@@ -25,6 +29,9 @@ import displayio
 import fourwire
 import adafruit_ssd1680
 
+from eink_refresh import (set_refresh_mode, label_rect, union_rect,
+                          RefreshPolicy)
+
 
 # drawing parameters
 DISPLAY_WIDTH  = 250
@@ -40,15 +47,71 @@ RED = 0xFF0000
 # Change text colors, choose from the following values:
 FG_COLOR = BLACK
 BG_COLOR = WHITE
+# the panel's third color, None for the mono (black and white) panel
+HIGHLIGHT_COLOR = RED
 
 REFRESH_INTVL = 300
+# Adafruit IO group the sensor node publishes to
+FEED_GROUP = 'Porch'
+# REST API, for the last values on (re)connect; can be overridden
+# (secrets['aio_url']) to test against a stand-in
+AIO_URL = "https://io.adafruit.com"
 #LOCAL_TZ_HOURS = -8             # PST
 LOCAL_TZ_HOURS = -7             # PDT
 
 # enable extra logging:
 DEBUG = False
-# caching code seems to have unknown problems (ESP32-S3 CP beta bugs?)
-CACHE_GROUPS = False
+# keep one display group and update its labels in place, instead of
+# allocating a new group, background bitmap and labels on every refresh
+# (those were fragmenting the heap on the ESP32-S3)
+CACHE_GROUPS = True
+
+# partial refresh: only redraw the labels that changed, using the SSD1680's
+# partial update mode, and force a full refresh every FULL_REFRESH_CYCLES
+# partials (or FULL_REFRESH_SECS) to clear the ghosting they leave behind.
+# (Partial mode needs the mono panel, HIGHLIGHT_COLOR = None: on the
+# tri-color one this only spaces out the full refreshes, see eink_refresh.py)
+PARTIAL_REFRESH = False
+PARTIAL_REFRESH_INTVL = 60
+FULL_REFRESH_CYCLES = 10
+FULL_REFRESH_SECS = 3600
+# fraction of the screen above which a partial isn't worth it
+FULL_REFRESH_AREA = 0.5
+
+# change gating: skip the refresh when no value moved by more than its
+# deadband since it was put on the glass, but never let the panel (and the
+# time shown on it) get older than MAX_STALENESS seconds
+CHANGE_GATING = False
+DEADBANDS = {
+    'alt-temp': 0.2,            # deg F (also when displaying Celsius)
+    'alt-humidity': 0.5,        # % RH
+    'pressure': 0.05,           # in-Hg
+    'battery-charge': 1.0,      # %
+}
+MAX_STALENESS = 1800
+
+# the MQTT receive loop, the refresh scheduler and the display refresh run
+# as asyncio tasks, so the broker connection is serviced while the panel is
+# busy: each pass of the receive task blocks in io.loop() for at most
+# MQTT_LOOP_SECS (no less than the MQTT client's 1s socket timeout), the
+# other tasks check in every TASK_POLL_SECS
+MQTT_LOOP_SECS = 1
+TASK_POLL_SECS = 1
+
+# recovery from MQTT/network errors: reconnect just the MQTT session first,
+# after RECOVERY_TRIES failed attempts reconnect Wi-Fi too, after as many
+# more re-create the display as well.  Between attempts wait BACKOFF_BASE
+# seconds, doubling up to BACKOFF_MAX, less a random jitter of up to half.
+RECOVERY_TRIES = 3
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 60
+
+# keep time with the board's RTC, set from Adafruit IO's time and resynced
+# every RTC_RESYNC_SECS (retrying every RTC_RETRY_SECS), instead of
+# subscribing to the MQTT time feed and its message every second
+LOCAL_RTC = False
+RTC_RESYNC_SECS = 3600
+RTC_RETRY_SECS = 60
 
 
 def create_display():
@@ -78,7 +141,7 @@ def create_display():
         width=DISPLAY_WIDTH,
         height=DISPLAY_HEIGHT,
         busy_pin=epd_busy,
-        highlight_color=RED,
+        highlight_color=HIGHLIGHT_COLOR,
         rotation=270,
     )
     return display
@@ -87,19 +150,20 @@ def create_display():
     #print('display refresh= ', display.time_to_refresh)
 
 
-def get_network_io_handle():
-    """Configure wifi network and Adafruit_IO handle"""
-    logger = logging.getLogger('wifi')
-
+def get_secrets():
     # Get wifi details and more from a secrets.py file
     try:
         from secrets import secrets
     except ImportError:
         #print("WiFi connect failed: no secrets.py file")
-        logger.error("WiFi connect failed: no secrets.py file")
+        logging.getLogger('wifi').error("WiFi connect failed: no secrets.py file")
         # maybe flash neopixel with some pattern?
         raise
+    return secrets
 
+
+def connect_wifi(secrets):
+    logger = logging.getLogger('wifi')
     mac = ':'.join(f'{i:02x}' for i in wifi.radio.mac_address)
     logger.info(f"My MAC addr: {mac}")
 
@@ -110,8 +174,21 @@ def get_network_io_handle():
     logger.info("Connected to %s!"%secrets["ssid"])
     logger.info(f"My IP address is {wifi.radio.ipv4_address}")
 
+
+def reset_wifi(secrets):
+    """Drop the association (if any) and connect to the AP again"""
+    wifi.radio.enabled = False
+    wifi.radio.enabled = True
+    connect_wifi(secrets)
+
+
+def get_network_io_handle(secrets):
+    """Configure wifi network, Adafruit_IO handle and REST session"""
+    connect_wifi(secrets)
+
     # Create a socket pool
     pool = socketpool.SocketPool(wifi.radio)
+    ssl_context = ssl.create_default_context()
 
     # Initialize a new MQTT Client object
     mqtt_client = MQTT.MQTT(
@@ -120,13 +197,69 @@ def get_network_io_handle():
         username=secrets["aio_username"],
         password=secrets["aio_key"],
         socket_pool=pool,
-        ssl_context=ssl.create_default_context(),
+        ssl_context=ssl_context,
         keep_alive=120
     )
 
     # Initialize an Adafruit IO MQTT Client
     io = IO_MQTT(mqtt_client)
-    return io
+    http = adafruit_requests.Session(pool, ssl_context)
+    return io, http
+
+
+def connect_mqtt(io):
+    """(Re)connect to Adafruit IO and subscribe to the feeds"""
+    if io.is_connected():
+        io.disconnect()
+    io.connect()
+
+    # use time subscription vs NTP or something else
+    if not LOCAL_RTC:
+        io.subscribe_to_time("seconds")
+    #io.subscribe_to_time("iso")
+
+    ## alt idea:
+    #tm_struct = io.receive_time()
+
+    # Subscribe to Group
+    io.subscribe(group_key=FEED_GROUP)
+
+
+class Recovery:
+    """Escalating recovery from a lost connection: each failed attempt
+    backs off further, and every RECOVERY_TRIES failures move on to the
+    next level (MQTT session, then Wi-Fi, then display)."""
+    LEVELS = ('mqtt', 'wifi', 'display')
+
+    def __init__(self, tries=RECOVERY_TRIES, base=BACKOFF_BASE,
+                 cap=BACKOFF_MAX):
+        self.tries = tries
+        self.base = base
+        self.cap = cap
+        # failed attempts since the connection was last up
+        self.failures = 0
+        # attempts, and successful recoveries, at each level
+        self.attempts = {level: 0 for level in self.LEVELS}
+        self.recovered = {level: 0 for level in self.LEVELS}
+
+    def next_attempt(self):
+        """Returns (level, seconds to wait first) for the next attempt"""
+        index = min(self.failures // self.tries, len(self.LEVELS) - 1)
+        level = self.LEVELS[index]
+        self.attempts[level] += 1
+        delay = min(self.base * 2 ** self.failures, self.cap)
+        return level, delay * (1 - random.random() / 2)
+
+    def failed(self):
+        self.failures += 1
+
+    def succeeded(self, level):
+        self.recovered[level] += 1
+        self.failures = 0
+
+    def summary(self):
+        return ' '.join(f'{level}={self.recovered[level]}/{self.attempts[level]}'
+                        for level in self.LEVELS)
 
 
 current_vals = {}
@@ -147,16 +280,105 @@ def recv_vals(client, feed_id, payload):
             # print times only 1/min
             logger.info(f'MQTT time: {feed_id} = {secs}')
 
-    elif feed_id == 'Porch':
+    elif feed_id == FEED_GROUP:
         data = json.loads(payload)
         for key,val in data['feeds'].items():
-            logger.info(f'MQTT update: {key} = {val}')
+            logger.debug(f'MQTT update: {key} = {val}')
             current_vals[key] = float(val)
 
     else:
         logger.warning(f'MQTT unknown: {feed_id} = {payload}')
 
 
+def fetch_time(http, secrets):
+    """Adafruit IO's time (UTC seconds)"""
+    aio_url = secrets.get('aio_url', AIO_URL)
+    with http.get(f'{aio_url}/api/v2/time/seconds') as response:
+        return int(response.text)
+
+
+def fetch_last_values(http, secrets, vals_dict, clock=None):
+    """Get the time and the group's last values from the REST API, so the
+    first frame after a (re)connect doesn't wait for the next publish.
+    The time goes to the clock (a LocalClock) if there is one."""
+    logger = logging.getLogger('fetch')
+    aio_url = secrets.get('aio_url', AIO_URL)
+    headers = {'X-AIO-Key': secrets['aio_key']}
+    url = (f'{aio_url}/api/v2/{secrets["aio_username"]}/groups/'
+           f'{FEED_GROUP.lower()}')
+    try:
+        secs = fetch_time(http, secrets)
+        with http.get(url, headers=headers) as response:
+            if response.status_code != 200:
+                raise RuntimeError(f'status {response.status_code}')
+            feeds = response.json()['feeds']
+    except (OSError, RuntimeError, ValueError) as e:
+        # no harm done, MQTT will bring the values in eventually
+        logger.warning(f'could not fetch the last values: {e}')
+        return
+    if clock:
+        clock.set(secs)
+    else:
+        vals_dict['seconds'] = secs
+    for feed in feeds:
+        # the group's feed keys are 'porch.alt-temp', MQTT just 'alt-temp'
+        key = feed['key'].rpartition('.')[2]
+        try:
+            vals_dict[key] = float(feed['last_value'])
+        except (KeyError, TypeError, ValueError):
+            continue
+        logger.info(f'last value: {key} = {vals_dict[key]}')
+
+
+class LocalClock:
+    """The board's RTC, set from Adafruit IO's time every resync_secs"""
+    def __init__(self, resync_secs=RTC_RESYNC_SECS):
+        self.resync_secs = resync_secs
+        self.last_sync = None
+
+    def set(self, secs):
+        if self.last_sync is not None:
+            logging.getLogger('clock').info(
+                f'RTC resync: was off by {time.time() - secs}s')
+        rtc.RTC().datetime = time.localtime(secs)
+        self.last_sync = time.monotonic()
+
+    def synced(self):
+        return self.last_sync is not None
+
+    def secs_to_sync(self):
+        if self.last_sync is None:
+            return 0
+        return max(self.last_sync + self.resync_secs - time.monotonic(), 0)
+
+
+class ChangeGate:
+    """Decide whether new feed values are worth waking up the panel."""
+    def __init__(self, deadbands=DEADBANDS, max_staleness=MAX_STALENESS):
+        self.deadbands = deadbands
+        self.max_staleness = max_staleness
+        # values currently on the glass, and when they were put there
+        self.shown = {}
+        self.shown_time = None
+        self.skipped = 0
+
+    def should_refresh(self, val_map, now):
+        if ( self.shown_time is None or
+             now - self.shown_time >= self.max_staleness ):
+            return True
+        for key, band in self.deadbands.items():
+            if key not in val_map:
+                continue
+            if key not in self.shown or abs(val_map[key] - self.shown[key]) >= band:
+                return True
+        self.skipped += 1
+        return False
+
+    def mark_shown(self, val_map, now):
+        self.shown = {k: val_map[k] for k in self.deadbands if k in val_map}
+        self.shown_time = now
+
+
 class MyGraphics:
     # parameters
     SMALL_FONT =  "fonts/DejaVuSans-Bold-16.pcf"
@@ -177,29 +399,48 @@ class MyGraphics:
         self._humid_str = ''
         self._barom_str = ''
         self._batt_str = ''
+        # the feed values the strings above were formatted from
+        self._formatted = {}
 
         # use this to cache the group of labels:
         self.display_group = None
+        # screen areas (x, y, w, h) changed by the last get_display_group()
+        self.dirty = []
 
     def update_values(self, val_map):
-        self.logger.info('Update: current_vals =')
-        for k,v in val_map.items():
-            self.logger.info(f'    {k} = {v}')
+        """Format the time, and the feeds that changed since the last frame"""
+        if DEBUG:
+            self.logger.debug('Update: current_vals =')
+            for k,v in val_map.items():
+                self.logger.debug(f'    {k} = {v}')
 
-        mytime = val_map['seconds']
+        # (no 'seconds' with LOCAL_RTC: the RTC has the time)
+        mytime = val_map.get('seconds')
         self.update_time(now=mytime, tz_offset=self.tz_offset_seconds)
 
+        # the rest only when changed, with placeholders until known
         temp = val_map.get('alt-temp', 100)
-        self.update_temp(temp)
+        if self._changed('alt-temp', temp):
+            self.update_temp(temp)
 
         humid = val_map.get('alt-humidity', 10)
-        self._humid_str = f'{humid:.1f}% RH'
+        if self._changed('alt-humidity', humid):
+            self._humid_str = f'{humid:.1f}% RH'
 
         barom = val_map.get('pressure', 30)
-        self._barom_str = f'{barom:.1f} in-Hg'
+        if self._changed('pressure', barom):
+            self._barom_str = f'{barom:.1f} in-Hg'
 
         batt = val_map.get('battery-charge', 0)
-        self._batt_str = f'Batt: {batt:.1f}%'
+        if self._changed('battery-charge', batt):
+            self._batt_str = f'Batt: {batt:.1f}%'
+
+    def _changed(self, key, value):
+        """True (and remember the value) if it isn't the one last formatted"""
+        if key in self._formatted and self._formatted[key] == value:
+            return False
+        self._formatted[key] = value
+        return True
 
     def update_time(self, now=None, tz_offset=0):
         # allow for current time to be passed in, otherwise use now()
@@ -230,8 +471,20 @@ class MyGraphics:
         else:
             self._temp_str = "%.1f °F" % temperature
         
+    def _update_label(self, label, text, right_align=False):
+        """Set new text on a cached label and record the area it dirtied"""
+        if label.text == text:
+            return
+        old_rect = label_rect(label)
+        old_width = label.width
+        label.text = text
+        # right-column labels only need moving when their width changed
+        if right_align and label.width != old_width:
+            label.x = self.disp_width - label.width - 10
+        self.dirty.append(union_rect(old_rect, label_rect(label)))
+
     def get_display_group(self, display_width, display_height):
-        if not CACHE_GROUPS or not self.display_group:
+        if not (CACHE_GROUPS or PARTIAL_REFRESH) or not self.display_group:
             # First time through, create a group for all the labels
             g = displayio.Group()
 
@@ -291,14 +544,16 @@ class MyGraphics:
             self.batt_text.y = self.disp_height - 3*font_height + DISPLAY_OFFSET
             g.append(self.batt_text)
 
+            self.dirty = [(0, 0, self.disp_width, self.disp_height)]
+
         else:
-            # don't create a new group, just update the labels
-            self.time_text.text = self._time_str
-            self.temp_text.text = self._temp_str
-            self.humid_text.text = self._humid_str
-            self.barom_text.text = self._barom_str
-            self.batt_text.text = self._batt_str
-            ## FIXME: what about resetting the x pos of the right-col labels?
+            # don't create a new group, just update the labels that changed
+            self.dirty = []
+            self._update_label(self.time_text, self._time_str)
+            self._update_label(self.temp_text, self._temp_str, right_align=True)
+            self._update_label(self.humid_text, self._humid_str, right_align=True)
+            self._update_label(self.barom_text, self._barom_str, right_align=True)
+            self._update_label(self.batt_text, self._batt_str)
             
         # return the cached groups
         if DEBUG:
@@ -311,47 +566,170 @@ class MyGraphics:
         return self.display_group
 
     
+async def refresh_display(display, state, vals, policy):
+    """Redraw the panel with the latest feed values"""
+    # EPaperDisplay raises RuntimeError('Refresh too soon') within
+    # seconds_per_frame of the last refresh (e.g. right after a recovery)
+    while display.time_to_refresh > 0:
+        await asyncio.sleep(min(display.time_to_refresh, TASK_POLL_SECS))
+    state.update_values(vals)
+    group = state.get_display_group(DISPLAY_WIDTH, DISPLAY_HEIGHT)
+    mode = 'full'
+    if PARTIAL_REFRESH:
+        mode = policy.next_refresh(state.dirty, time.monotonic())
+        if mode and (mode == 'partial') != policy.partial_mode:
+            policy.partial_mode = (mode == 'partial')
+            set_refresh_mode(display, policy.partial_mode,
+                             width=DISPLAY_WIDTH,
+                             seconds_per_frame=PARTIAL_REFRESH_INTVL,
+                             highlight_color=HIGHLIGHT_COLOR)
+        logging.getLogger('main').debug(f'refresh: {mode} dirty={state.dirty}')
+    if mode:
+        #display.show(group)  ## old syntax
+        display.root_group = group ## new syntax (CP >= 9.0)
+        display.refresh()
+        # let the MQTT task run while the panel is busy
+        while display.busy:
+            await asyncio.sleep(TASK_POLL_SECS)
+
+
+async def mqtt_task(io):
+    """Receive MQTT messages and keep the connection alive"""
+    while True:
+        io.loop(timeout=MQTT_LOOP_SECS)
+        await asyncio.sleep(0)
+
+
+async def clock_task(clock, http, secrets):
+    """Keep the RTC in sync with Adafruit IO's time"""
+    while True:
+        await asyncio.sleep(clock.secs_to_sync())
+        try:
+            clock.set(fetch_time(http, secrets))
+        except (OSError, RuntimeError, ValueError) as e:
+            logging.getLogger('clock').warning(f'RTC resync failed: {e}')
+            await asyncio.sleep(RTC_RETRY_SECS)
+
+
+async def scheduler_task(vals_dict, refresh_intvl, gate, refresh_due,
+                         clock=None):
+    """Ask for a refresh every refresh_intvl seconds (unless gated)"""
+    # (carry on from the last refresh when restarted after a recovery)
+    last_time = gate.shown_time or 0
+    #last_time = time.monotonic()
+    while True:
+        t = time.monotonic()
+        if clock:
+            ready = clock.synced()
+        else:
+            # make sure to wait until we get one MQTT time update
+            ready = ('seconds' in vals_dict)
+        if  ( (last_time == 0 and ready) or 
+              (last_time > 0 and (t - last_time) > refresh_intvl) ):
+            last_time = t
+            if CHANGE_GATING and not gate.should_refresh(vals_dict, t):
+                logging.getLogger('main').info(
+                    f'no visible change, refresh skipped ({gate.skipped} so far)')
+            else:
+                gate.mark_shown(vals_dict, t)
+                refresh_due.set()
+        await asyncio.sleep(TASK_POLL_SECS)
+
+
+async def display_task(display, state, vals_dict, policy, refresh_due):
+    """Redraw the panel whenever the scheduler asks for it"""
+    while True:
+        await refresh_due.wait()
+        refresh_due.clear()
+        await refresh_display(display, state, vals_dict, policy)
+
+
+async def run_tasks(io, display, state, vals_dict, policy, gate,
+                    refresh_intvl, clock=None, http=None, secrets=None):
+    """Run the tasks until one of them fails, then stop the others"""
+    refresh_due = asyncio.Event()
+    tasks = [
+        asyncio.create_task(mqtt_task(io)),
+        asyncio.create_task(scheduler_task(vals_dict, refresh_intvl, gate,
+                                           refresh_due, clock)),
+        asyncio.create_task(display_task(display, state, vals_dict, policy,
+                                         refresh_due)),
+    ]
+    if clock:
+        tasks.append(asyncio.create_task(clock_task(clock, http, secrets)))
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # (so they don't linger into the next round of main())
+        for task in tasks:
+            task.cancel()
+
+
 def main(vals_dict):
+    logger = logging.getLogger('main')
     display = create_display()
     state = MyGraphics(celsius=False, tz_offset=LOCAL_TZ_HOURS*3600)
+    policy = RefreshPolicy(DISPLAY_WIDTH, DISPLAY_HEIGHT,
+                           full_cycles=FULL_REFRESH_CYCLES,
+                           full_secs=FULL_REFRESH_SECS,
+                           full_area=FULL_REFRESH_AREA,
+                           partial=HIGHLIGHT_COLOR is None)
+    gate = ChangeGate()
+    clock = LocalClock() if LOCAL_RTC else None
+    refresh_intvl = REFRESH_INTVL
+    if PARTIAL_REFRESH:
+        refresh_intvl = PARTIAL_REFRESH_INTVL
+        set_refresh_mode(display, policy.partial_mode, width=DISPLAY_WIDTH,
+                         seconds_per_frame=PARTIAL_REFRESH_INTVL,
+                         highlight_color=HIGHLIGHT_COLOR)
 
     # Connect to Adafruit IO
-    io = get_network_io_handle()
+    secrets = get_secrets()
+    io, http = get_network_io_handle(secrets)
 
     # Connect the callback method defined above to Adafruit IO
     io.on_message = recv_vals
-    io.connect()
-
-    # use time subscription vs NTP or something else
-    io.subscribe_to_time("seconds")
-    #io.subscribe_to_time("iso")
-
-    ## alt idea:
-    #tm_struct = io.receive_time()
-
-    # Subscribe to Group
-    io.subscribe(group_key='Porch')
+    connect_mqtt(io)
+    fetch_last_values(http, secrets, vals_dict, clock)
 
-    last_time = 0
-    #last_time = time.monotonic()
+    recovery = Recovery()
     while True:
-        t = time.monotonic()
-        # make sure to wait until we get one MQTT time update
-        ready = ('seconds' in vals_dict)
-        if  ( (last_time == 0 and ready) or 
-              (last_time > 0 and (t - last_time) > REFRESH_INTVL) ):
-            last_time = t
-            state.update_values(vals_dict)
-            group = state.get_display_group(DISPLAY_WIDTH, DISPLAY_HEIGHT)
-            #display.show(group)  ## old syntax
-            display.root_group = group ## new syntax (CP >= 9.0)
-            display.refresh()
-            while display.busy:
-                time.sleep(1)
+        try:
+            # MQTT exceptions from the tasks end up here
+            asyncio.run(run_tasks(io, display, state, vals_dict, policy, gate,
+                                  refresh_intvl, clock, http, secrets))
+        except (MQTT.MMQTTException, AdafruitIO_MQTTError, OSError) as e:
+            ## apparently, protocol exceptions happen fairly frequently
+            logger.error('MQTT exception: %s', e)
 
-        # otherwise just loop receiving MQTT messages
-        io.loop(timeout=5)
-        #time.sleep(1)
+        # recover only as much as it takes to get the connection back
+        while True:
+            level, delay = recovery.next_attempt()
+            logger.info(f'recovering ({level}) in {delay:.1f}s')
+            time.sleep(delay)
+            try:
+                if level == 'display':
+                    display = create_display()
+                    # (the new display starts out in full update mode;
+                    # the policy still knows when the glass last had a
+                    # full refresh)
+                    policy.partial_mode = False
+                    if PARTIAL_REFRESH:
+                        set_refresh_mode(display, False, width=DISPLAY_WIDTH,
+                                         seconds_per_frame=PARTIAL_REFRESH_INTVL,
+                                         highlight_color=HIGHLIGHT_COLOR)
+                if level != 'mqtt':
+                    reset_wifi(secrets)
+                connect_mqtt(io)
+            except (MQTT.MMQTTException, AdafruitIO_MQTTError, OSError) as e:
+                logger.error('recovery (%s) failed: %s', level, e)
+                recovery.failed()
+                continue
+            recovery.succeeded(level)
+            logger.info(f'recovered ({level}): {recovery.summary()}')
+            # (catch up on whatever was published while we were away)
+            fetch_last_values(http, secrets, vals_dict, clock)
+            break
 
 
 ## actual exec here:
@@ -362,7 +740,8 @@ if __name__ == '__main__':
     else:
         logger.setLevel(logging.INFO)
 
-    # loop in order to retry main() after an exception
+    # main() recovers from lost connections itself: this loop retries it
+    # when the start-up fails
     while True:
         try:
             main(current_vals)
@@ -373,10 +752,6 @@ if __name__ == '__main__':
             ## swallow this exception and try another round at main()
             pass
 
-            #wifi.reset()
-            #wifi.connect()
-            #io.reconnect()
-
         except AdafruitIO_MQTTError as e:
             ## apparently, connection exceptions also happen fairly frequently
             logger.error('MQTT exception: %s', e)
@@ -12,16 +12,18 @@ from adafruit_display_text.bitmap_label import Label
 from adafruit_display_shapes.rect import Rect
 
 import wifi
-import ssl
-import socketpool
 import adafruit_minimqtt.adafruit_minimqtt as MQTT
 from adafruit_io.adafruit_io import IO_MQTT
 import adafruit_requests as requests
+import adafruit_connection_manager
 
 import board
 import displayio
 import adafruit_ssd1680
 
+from eink_refresh import (set_refresh_mode, label_rect, union_rect,
+                          RefreshPolicy)
+
 
 # release any previously configured displays
 displayio.release_displays()
@@ -47,6 +49,40 @@ RED = 0xFF0000
 # Change text colors, choose from the following values:
 FG_COLOR = BLACK
 BG_COLOR = WHITE
+# the panel's third color, None for the mono (black and white) panel
+HIGHLIGHT_COLOR = RED
+
+# seconds between frames; the next frame's weather is fetched while the
+# panel is busy with this one
+REFRESH_INTVL = 300
+
+# partial refresh: only redraw the labels that changed, using the SSD1680's
+# partial update mode, and force a full refresh every FULL_REFRESH_CYCLES
+# partials (or FULL_REFRESH_SECS) to clear the ghosting they leave behind.
+# Frames then come every PARTIAL_REFRESH_INTVL instead of REFRESH_INTVL.
+# (Partial mode needs the mono panel, HIGHLIGHT_COLOR = None: on the
+# tri-color one this only spaces out the full refreshes, see eink_refresh.py)
+PARTIAL_REFRESH = False
+PARTIAL_REFRESH_INTVL = 60
+FULL_REFRESH_CYCLES = 10
+FULL_REFRESH_SECS = 3600
+# fraction of the screen above which a partial isn't worth it
+FULL_REFRESH_AREA = 0.5
+
+# the parts of the OWM response Weather_Graphics uses: the response is
+# parsed as it's read, READ_CHUNK bytes at a time, keeping only these
+# (a forecast would use paths like 'list[3].main.temp')
+OWM_FIELDS = (
+    'weather[0].icon', 'weather[0].main', 'weather[0].description',
+    'main.temp', 'name', 'sys.country', 'dt', 'timezone',
+)
+READ_CHUNK = 256
+
+# OWM updates its data every 10 minutes: fetch no more often than that
+# (this is also how often main() refetches).  When a fetch fails, the last
+# data is shown with STALE_MARK on the temperature.
+WEATHER_TTL = 600
+STALE_MARK = '*'
 
 
 # Map the OpenWeatherMap icon code to the appropriate font character
@@ -75,9 +111,9 @@ ICON_MAP = {
 
 class Weather_Graphics:
     # parameters:
-    SMALL_FONT =  "fonts/DejaVuSans-Bold16.pcf"
-    MEDIUM_FONT = "fonts/DejaVuSans20.pcf"
-    LARGE_FONT =  "fonts/DejaVuSans-Bold24.pcf"
+    SMALL_FONT =  "fonts/DejaVuSans-Bold-16.pcf"
+    MEDIUM_FONT = "fonts/DejaVuSans-20.pcf"
+    LARGE_FONT =  "fonts/DejaVuSans-Bold-24.pcf"
     #ICON_FONT =   "fonts/meteocons.ttf"
     ICON_FONT =   "fonts/Meteocons48.pcf"
 
@@ -92,6 +128,8 @@ class Weather_Graphics:
 
         # use this to cache the group of labels:
         self.display_group = None
+        # screen areas (x, y, w, h) changed by the last get_display_group()
+        self.dirty = []
 
         self._weather_icon = None
         self._city_name = None
@@ -100,8 +138,9 @@ class Weather_Graphics:
         self._description = None
         self._time_text = None
 
-    def update_weather(self, weather):
-        """Pass in dict with parsed response from OWM and update graphics"""
+    def update_weather(self, weather, stale=False):
+        """Pass in dict with parsed response from OWM and update graphics
+        (stale: it's old data, a fresh fetch failed)"""
         #weather = json.loads(data)
 
         # set the icon/background
@@ -121,6 +160,8 @@ class Weather_Graphics:
             self._temperature = "%d °C" % temperature
         else:
             self._temperature = "%d °F" % ((temperature * 9 / 5) + 32)
+        if stale:
+            self._temperature += STALE_MARK
 
         description = weather["weather"][0]["description"]
         description = description[0].upper() + description[1:]
@@ -148,6 +189,17 @@ class Weather_Graphics:
         self._time_text = f'{hour:2d}:{ts.tm_min:02d}{am_pm}'
         #self._time_text = now.strftime("%I:%M %p").lstrip("0").replace(" 0", " ")
 
+    def _update_label(self, label, text, right_align=False):
+        """Set new text on a cached label and record the area it dirtied"""
+        if label.text == text:
+            return
+        old_rect = label_rect(label)
+        label.text = text
+        if right_align:
+            (x, y, w, h) = label.bounding_box
+            label.x = self.disp_width - w - 10
+        self.dirty.append(union_rect(old_rect, label_rect(label)))
+
     def get_display_group(self, display_width, display_height):
         if not self.display_group:
             # First time through, create a group for all the labels
@@ -253,14 +305,17 @@ class Weather_Graphics:
                               outline=BLACK, stroke=1))
             g.append(self.temp_text)
 
+            self.dirty = [(0, 0, self.disp_width, self.disp_height)]
+
         else:
-            # don't create a new group, just update the labels
-            self.icon_text.text = self._weather_icon
-            self.city_text.text = self._city_name
-            self.time_text.text = self._time_text
-            self.main_text.text = self._main_text
-            self.desc_text.text = self._description
-            self.temp_text.text = self._temperature
+            # don't create a new group, just update the labels that changed
+            self.dirty = []
+            self._update_label(self.icon_text, self._weather_icon, right_align=True)
+            self._update_label(self.city_text, self._city_name)
+            self._update_label(self.time_text, self._time_text)
+            self._update_label(self.main_text, self._main_text)
+            self._update_label(self.desc_text, self._description)
+            self._update_label(self.temp_text, self._temperature, right_align=True)
 
         # return the cached groups
         return self.display_group
@@ -297,7 +352,7 @@ def create_display():
         width=DISPLAY_WIDTH,
         height=DISPLAY_HEIGHT,
         busy_pin=epd_busy,
-        highlight_color=RED,
+        highlight_color=HIGHLIGHT_COLOR,
         rotation=270,
     )
     return display
@@ -306,6 +361,171 @@ def create_display():
     #print('display refresh= ', display.time_to_refresh)
 
 
+class JSONExtractor:
+    """Incremental JSON scanner that keeps only the values at the given
+    paths ('main.temp', 'weather[0].icon', ...), and returns them in a
+    document of the same shape.  Feed it the response in chunks: the
+    whole text is never held, and nor is anything outside those paths
+    (strings being skipped aren't even collected)."""
+    # byte values: blanks, what ends a number/literal, brackets
+    BLANKS = (0x20, 0x09, 0x0D, 0x0A)
+    SCALAR_END = BLANKS + (0x2C, 0x5D, 0x7D)
+    OPEN = (0x7B, 0x5B)
+    CLOSE = (0x7D, 0x5D)
+
+    def __init__(self, paths):
+        self.paths = set(paths)
+        # containers on the way to a path (the others are skipped whole)
+        self.prefixes = set()
+        for path in paths:
+            for i, c in enumerate(path):
+                if c in '.[':
+                    self.prefixes.add(path[:i])
+        self.result = {}
+        self.found = 0
+        # one [key or index, is_array, expecting_key] per open container
+        self.stack = []
+        self.skip_depth = 0         # inside a skipped container
+        self.in_string = False
+        self.escape = False
+        self.token = None           # bytearray of the key/value kept
+        self.scalar = False         # reading a number/true/false/null
+
+    def done(self):
+        """True once every path was found: the rest needn't be parsed"""
+        return self.found == len(self.paths)
+
+    def _path(self):
+        path = ''
+        for key, is_array, expecting_key in self.stack:
+            if is_array:
+                path += f'[{key}]'
+            elif path:
+                path += '.' + key
+            else:
+                path = key
+        return path
+
+    def _put(self, path, value):
+        node = self.result
+        parts = path.replace('[', '.[').split('.')
+        for part, nxt in zip(parts, parts[1:] + [None]):
+            key = int(part[1:-1]) if part.startswith('[') else part
+            if nxt is None:
+                child = value
+            elif nxt.startswith('['):
+                child = []
+            else:
+                child = {}
+            if isinstance(node, list):
+                # (indexes we skipped stay None)
+                while len(node) <= key:
+                    node.append(None)
+                if node[key] is None:
+                    node[key] = child
+                node = node[key]
+            else:
+                node = node.setdefault(key, child)
+        self.found += 1
+
+    def _wanted(self):
+        """Is the value starting here one to keep?"""
+        return self._path() in self.paths
+
+    def _end_scalar(self):
+        text = bytes(self.token).decode()
+        if text == 'true':
+            value = True
+        elif text == 'false':
+            value = False
+        elif text == 'null':
+            value = None
+        elif '.' in text or 'e' in text or 'E' in text:
+            value = float(text)
+        else:
+            value = int(text)
+        self._put(self._path(), value)
+        self.token = None
+
+    def _end_string(self):
+        top = self.stack[-1] if self.stack else None
+        raw = bytes(self.token) if self.token is not None else None
+        self.token = None
+        if top and not top[1] and top[2]:
+            # an object key: (json.loads() only for escapes)
+            key = raw.decode()
+            top[0] = json.loads(f'"{key}"') if '\\' in key else key
+            top[2] = False
+        elif raw is not None:
+            text = raw.decode()
+            self._put(self._path(), json.loads(f'"{text}"')
+                      if '\\' in text else text)
+
+    def feed(self, chunk):
+        """Scan the next chunk (bytes); returns done()"""
+        if self.done():
+            return True
+        for c in chunk:
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif c == 0x5C:                 # backslash
+                    self.escape = True
+                elif c == 0x22:                 # closing quote
+                    self.in_string = False
+                    if not self.skip_depth:
+                        self._end_string()
+                    continue
+                if self.token is not None:
+                    self.token.append(c)
+                continue
+            if self.scalar:
+                if c not in self.SCALAR_END:
+                    if self.token is not None:
+                        self.token.append(c)
+                    continue
+                self.scalar = False
+                if self.token is not None:
+                    self._end_scalar()
+            if c in self.BLANKS:
+                continue
+            if self.skip_depth:
+                if c == 0x22:
+                    self.in_string = True
+                elif c in self.OPEN:
+                    self.skip_depth += 1
+                elif c in self.CLOSE:
+                    self.skip_depth -= 1
+                continue
+
+            top = self.stack[-1] if self.stack else None
+            expecting_key = top and not top[1] and top[2]
+            if c == 0x22:                       # string: key or value
+                self.in_string = True
+                if expecting_key or self._wanted():
+                    self.token = bytearray()
+            elif c in self.OPEN:
+                if self.stack and self._path() not in self.prefixes:
+                    self.skip_depth = 1
+                else:
+                    self.stack.append([0, c == 0x5B, c == 0x7B])
+            elif c in self.CLOSE:
+                self.stack.pop()
+            elif c == 0x2C:                     # comma
+                if top[1]:
+                    top[0] += 1
+                else:
+                    top[2] = True
+            elif c == 0x3A:                     # colon
+                pass
+            else:
+                # number, true, false or null
+                self.scalar = True
+                if self._wanted():
+                    self.token = bytearray((c,))
+        return self.done()
+
+
 def get_network_io_handle():
     """Configure wifi network and Adafruit_IO handle"""
     logger = logging.getLogger('wifi')
@@ -327,8 +547,10 @@ def get_network_io_handle():
     logger.info("Connected to %s!"%secrets["ssid"])
     logger.info(f"My IP address is {wifi.radio.ipv4_address}")
 
-    # Create a socket pool
-    pool = socketpool.SocketPool(wifi.radio)
+    # the radio's one socket pool and SSL context, shared with the HTTP
+    # session (see get_session())
+    pool = adafruit_connection_manager.get_radio_socketpool(wifi.radio)
+    ssl_context = adafruit_connection_manager.get_radio_ssl_context(wifi.radio)
 
     # Initialize a new MQTT Client object
     mqtt_client = MQTT.MQTT(
@@ -337,7 +559,7 @@ def get_network_io_handle():
         username=secrets["aio_username"],
         password=secrets["aio_key"],
         socket_pool=pool,
-        ssl_context=ssl.create_default_context(),
+        ssl_context=ssl_context,
     )
 
     # Initialize an Adafruit IO MQTT Client
@@ -345,6 +567,20 @@ def get_network_io_handle():
     return io
 
 
+_session = None
+
+def get_session():
+    """The one HTTP session, on the radio's shared socket pool: its
+    connections are kept alive and reused from one fetch to the next"""
+    global _session
+    if _session is None:
+        pool = adafruit_connection_manager.get_radio_socketpool(wifi.radio)
+        ssl_context = adafruit_connection_manager.get_radio_ssl_context(
+            wifi.radio)
+        _session = requests.Session(pool, ssl_context)
+    return _session
+
+
 def get_weather_info():
     logger = logging.getLogger('weather')
 
@@ -374,39 +610,133 @@ def get_weather_info():
     DATA_SOURCE = ( DATA_SOURCE_URL + "?" + "q=" + quoted_location +
                     "&appid=" + OPEN_WEATHER_TOKEN )
 
-    # Create a socket pool
-    pool = socketpool.SocketPool(wifi.radio)
-
-    server = requests.Session(pool, ssl.create_default_context())
-    response = server.get(DATA_SOURCE).json()
-
-    return response
-
-
-def main(owm_data):
+    # parse as it comes in, keeping only the fields we show
+    with get_session().get(DATA_SOURCE, stream=True) as response:
+        if response.status_code != 200:
+            raise RuntimeError(f'weather fetch failed: {response.status_code}')
+        return parse_weather(response.iter_content(chunk_size=READ_CHUNK))
+
+
+def parse_weather(chunks):
+    """The OWM_FIELDS of a response read in chunks (bytes).  Raises
+    ValueError when some are missing (e.g. the response was cut short), so
+    WeatherCache keeps showing the last good data instead."""
+    extractor = JSONExtractor(OWM_FIELDS)
+    # (read to the end even when done: the socket may get reused)
+    for chunk in chunks:
+        extractor.feed(chunk)
+    if not extractor.done():
+        raise ValueError(f'weather response has only {extractor.found} of '
+                         f'{len(OWM_FIELDS)} fields')
+    return extractor.result
+
+
+class WeatherCache:
+    """The last weather fetched, reused for ttl seconds.  When a fetch
+    fails, the last good data is served (stale is set) and the next get()
+    tries again; only without any data does the error go through."""
+    def __init__(self, fetch=get_weather_info, ttl=WEATHER_TTL):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.data = None
+        self.fetched = None
+        self.stale = False
+
+    def get(self, ahead=0):
+        """The weather, fetched again if it's (or, ahead seconds from now,
+        will be) ttl seconds old"""
+        now = time.monotonic()
+        if self.data is not None and now + ahead - self.fetched < self.ttl:
+            return self.data
+        try:
+            self.data = self.fetch()
+        except (OSError, RuntimeError, ValueError) as e:
+            if self.data is None:
+                raise
+            logging.getLogger('weather').warning(
+                f'weather fetch failed, showing old data: {e}')
+            self.stale = True
+            return self.data
+        self.fetched = now
+        self.stale = False
+        return self.data
+
+
+class WeatherClock:
+    """The time to show: OWM's dt (the RTC isn't set here), run forward
+    on time.monotonic() between fetches.  A newer dt only ever moves it
+    ahead, so the clock doesn't jump back to each observation time."""
+    def __init__(self):
+        self.base = None
+        self.base_mono = None
+
+    def sync(self, dt):
+        now = self.now()
+        if now is None or dt > now:
+            self.base = dt
+            self.base_mono = time.monotonic()
+
+    def now(self):
+        if self.base is None:
+            return None
+        return self.base + int(time.monotonic() - self.base_mono)
+
+
+def main(cache):
     display = create_display()
     weather = Weather_Graphics(celsius=False, am_pm=True)
-    REFRESH_INTVL = 300
-
-    dt = owm_data['dt']
-    tz = owm_data['timezone']
-    #print('main called at dt= ', dt)
+    refresh_intvl = REFRESH_INTVL
+    policy = RefreshPolicy(DISPLAY_WIDTH, DISPLAY_HEIGHT,
+                           full_cycles=FULL_REFRESH_CYCLES,
+                           full_secs=FULL_REFRESH_SECS,
+                           full_area=FULL_REFRESH_AREA,
+                           partial=HIGHLIGHT_COLOR is None)
+    if PARTIAL_REFRESH:
+        refresh_intvl = PARTIAL_REFRESH_INTVL
+        set_refresh_mode(display, policy.partial_mode, width=DISPLAY_WIDTH,
+                         seconds_per_frame=PARTIAL_REFRESH_INTVL,
+                         highlight_color=HIGHLIGHT_COLOR)
+
+    clock = WeatherClock()
+    owm_data = cache.get()
+    clock.sync(owm_data['dt'])
+    #print('main called at dt= ', owm_data['dt'])
 
     while True:
-        weather.update_weather(owm_data)
-        weather.update_time(dt, tz)
-        display.show(weather.get_display_group(DISPLAY_WIDTH, DISPLAY_HEIGHT))
-        display.refresh()
+        start = time.monotonic()
+        weather.update_weather(owm_data, stale=cache.stale)
+        weather.update_time(clock.now(), owm_data['timezone'])
+        group = weather.get_display_group(DISPLAY_WIDTH, DISPLAY_HEIGHT)
+        mode = 'full'
+        if PARTIAL_REFRESH:
+            mode = policy.next_refresh(weather.dirty, time.monotonic())
+            if mode and (mode == 'partial') != policy.partial_mode:
+                policy.partial_mode = (mode == 'partial')
+                set_refresh_mode(display, policy.partial_mode,
+                                 width=DISPLAY_WIDTH,
+                                 seconds_per_frame=PARTIAL_REFRESH_INTVL,
+                                 highlight_color=HIGHLIGHT_COLOR)
+        if mode:
+            display.root_group = group
+            display.refresh()
+
+        # while the panel is busy, get the next frame's weather: refetched
+        # when it would be WEATHER_TTL old by then (less half a frame, so
+        # the fetches keep to every WEATHER_TTL despite timing jitter)
+        owm_data = cache.get(ahead=refresh_intvl / 2)
+        clock.sync(owm_data['dt'])
+
         while display.busy:
             time.sleep(1)
-        time.sleep(REFRESH_INTVL)
+        # (the fetch and the refresh are part of the interval)
+        time.sleep(max(refresh_intvl - (time.monotonic() - start), 0))
         print('refresh-limit timer reached (looping)')
 
 
 ## actual exec here:
 if __name__ == '__main__':
     io = get_network_io_handle()
-    weather = get_weather_info()
-    #print(weather)
-    #weather = dummy_data
-    main(weather)
+    cache = WeatherCache()
+    #print(cache.get())
+    #cache = WeatherCache(fetch=lambda: dummy_data)
+    main(cache)
@@ -0,0 +1,101 @@
+##
+## Partial refresh support for the SSD1680 e-ink scripts (eink-display.py
+## and eink-weather.py): copy this file to CIRCUITPY along with them.
+##
+## Partial updates only redraw what changed, but need the mono panel: the
+## tri-color one (driven with a highlight_color) only has the full
+## waveform, so set_refresh_mode() refuses partial mode for it, and
+## RefreshPolicy only schedules full refreshes there.
+##
+
+import adafruit_ssd1680
+
+
+# SSD1680 display update control values (cmd 0x22)
+FULL_UPDATE_MODE = 0xF4         # driver default: full waveform
+PARTIAL_UPDATE_MODE = 0xFC      # display mode 2: only drive changed pixels
+
+# the panel needs this long between full refreshes (the driver's default
+# seconds_per_frame, which set_refresh_mode() relaxes for the partials)
+FULL_REFRESH_MIN_SECS = 180
+
+
+def set_refresh_mode(display, partial, *, width, seconds_per_frame,
+                     highlight_color=None):
+    """Switch the display between full and partial update waveforms.
+    Raises ValueError for partial mode on a tri-color panel."""
+    if partial and highlight_color is not None:
+        raise ValueError('partial refresh needs the mono panel')
+    # rebuild the start sequence the same way the SSD1680 driver does, with
+    # the display update mode swapped out at the end
+    seq = bytearray(adafruit_ssd1680._START_SEQUENCE)
+    seq[15] = 0x36                          # vcom (driver default)
+    seq[24] = 0x00                          # vsh2 (driver default)
+    seq[38] = (width - 1) & 0xFF
+    seq[39] = ((width - 1) >> 8) & 0xFF
+    if partial:
+        seq += bytes((0x22, 0x00, 0x01, PARTIAL_UPDATE_MODE))
+    else:
+        seq += bytes((0x22, 0x00, 0x01, FULL_UPDATE_MODE))
+    # RefreshPolicy keeps the full refreshes FULL_REFRESH_MIN_SECS apart,
+    # so relax the minimum refresh period for both modes
+    display.update_refresh_mode(seq, seconds_per_frame)
+
+
+def label_rect(label):
+    """Screen area (x, y, w, h) covered by a label"""
+    (x, y, w, h) = label.bounding_box
+    return (label.x + x, label.y + y, w, h)
+
+
+def union_rect(a, b):
+    x0 = min(a[0], b[0])
+    y0 = min(a[1], b[1])
+    x1 = max(a[0] + a[2], b[0] + b[2])
+    y1 = max(a[1] + a[3], b[1] + b[3])
+    return (x0, y0, x1 - x0, y1 - y0)
+
+
+class RefreshPolicy:
+    """Choose between a partial and a full refresh for each new frame.
+
+    Partials leave some ghosting behind, so a full refresh is forced after
+    full_cycles partials or full_secs seconds, or when most of the screen
+    changed anyway; but never within min_full_secs of the last one (a
+    partial has to do until then).  With partial=False (the tri-color
+    panel) every frame is a full refresh, at most every min_full_secs."""
+    def __init__(self, width, height, *, full_cycles, full_secs, full_area,
+                 partial=True, min_full_secs=FULL_REFRESH_MIN_SECS):
+        self.full_cycles = full_cycles
+        self.full_secs = full_secs
+        self.full_area = full_area * width * height
+        self.partial = partial
+        self.min_full_secs = min_full_secs
+        self.partials = 0
+        self.last_full = None
+        # which waveform the display is currently set up for
+        self.partial_mode = False
+
+    def next_refresh(self, dirty, now):
+        """Returns 'full', 'partial' or None (nothing to redraw, or too
+        soon for a full refresh on a panel without partials)"""
+        area = sum(w * h for (x, y, w, h) in dirty)
+        if self.last_full is None:
+            full = True
+        elif now - self.last_full < self.min_full_secs:
+            full = False
+        elif not self.partial:
+            full = bool(dirty)
+        else:
+            full = ( area > self.full_area or
+                     (self.partials > 0 and
+                      (self.partials >= self.full_cycles or
+                       now - self.last_full >= self.full_secs)) )
+        if full:
+            self.partials = 0
+            self.last_full = now
+            return 'full'
+        if not dirty or not self.partial:
+            return None
+        self.partials += 1
+        return 'partial'
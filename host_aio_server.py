@@ -0,0 +1,154 @@
+#! /usr/bin/python3
+
+##
+## Stand-in for the bits of the Adafruit IO REST API the sensor node uses,
+## so batched uploads can be checked on the LAN: point the node at it with
+## secrets['aio_url'] = 'http://<host>:8080'.
+##
+## Every data point received is appended to a JSON-lines log; --check reads
+## the log back and reports, per feed, the points, gaps and duplicates of
+## the timestamped (batched) samples.  Single values, like the node's wake
+## profile, are just logged with the time they arrived.
+## A group GET (what the e-ink display asks for on connect) returns the
+## last value logged for each feed, as if they were all in that group.
+## --fail-rate makes that fraction of uploads fail (HTTP 503), to check
+## that the node resumes without losing or repeating samples.
+##
+## Usage:
+##   ./host_aio_server.py --log /tmp/aio.jsonl --fail-rate 0.2
+##   ./host_aio_server.py --log /tmp/aio.jsonl --check
+##
+
+import re
+import sys
+import json
+import time
+import calendar
+import random
+import argparse
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+TIME_PATH = '/api/v2/time/seconds'
+DATA_PATH = re.compile(r'/api/v2/([^/]+)/feeds/([^/]+)/data(/batch)?$')
+GROUP_PATH = re.compile(r'/api/v2/([^/]+)/groups/([^/]+)$')
+
+
+class AIOHandler(BaseHTTPRequestHandler):
+    # set by main()
+    log_file = None
+    fail_rate = 0.0
+
+    def reply(self, status, body):
+        data = body.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        match = GROUP_PATH.match(self.path)
+        if self.path == TIME_PATH:
+            self.reply(200, str(int(time.time())))
+        elif match:
+            group = match.group(2)
+            feeds = [{'key': f'{group}.{feed}', 'last_value': str(value)}
+                     for feed, value in last_values(self.log_file).items()]
+            self.reply(200, json.dumps({'key': group, 'feeds': feeds}))
+        else:
+            self.reply(404, '{"error": "not found"}')
+
+    def do_POST(self):
+        match = DATA_PATH.match(self.path)
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        if not match:
+            self.reply(404, '{"error": "not found"}')
+            return
+        if not self.headers.get('X-AIO-Key'):
+            self.reply(401, '{"error": "no key"}')
+            return
+        if random.random() < self.fail_rate:
+            self.reply(503, '{"error": "injected failure"}')
+            return
+        feed = match.group(2)
+        if match.group(3):
+            points = json.loads(body)['data']
+        else:
+            # single value (e.g. the wake profile): stamped on arrival
+            point = json.loads(body)
+            point.setdefault('received_at', int(time.time()))
+            points = [point]
+        with open(self.log_file, 'a') as f:
+            for point in points:
+                f.write(json.dumps({'feed': feed, **point}) + '\n')
+        self.reply(200, json.dumps(points))
+
+
+def last_values(log_file):
+    """feed -> the last value logged for it"""
+    values = {}
+    try:
+        with open(log_file) as f:
+            for line in f:
+                point = json.loads(line)
+                values[point['feed']] = point['value']
+    except FileNotFoundError:
+        pass
+    return values
+
+
+def check(log_file, interval):
+    """Report per feed: points, duplicates and gaps longer than 1.5 intervals"""
+    times = defaultdict(list)
+    with open(log_file) as f:
+        for line in f:
+            point = json.loads(line)
+            if 'created_at' not in point:
+                continue
+            times[point['feed']].append(
+                calendar.timegm(time.strptime(point['created_at'],
+                                              '%Y-%m-%dT%H:%M:%SZ')))
+    ok = True
+    for feed, stamps in sorted(times.items()):
+        dups = len(stamps) - len(set(stamps))
+        stamps = sorted(set(stamps))
+        gaps = sum(1 for a, b in zip(stamps, stamps[1:])
+                   if b - a > 1.5 * interval)
+        print(f'{feed:16s} {len(stamps):6d} points  {dups:4d} duplicates  '
+              f'{gaps:4d} gaps')
+        ok = ok and not dups and not gaps
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Local stand-in for the Adafruit IO batch data API')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--log', default='aio-data.jsonl',
+                        help='JSON-lines file the data points go to')
+    parser.add_argument('--fail-rate', type=float, default=0.0,
+                        help='fraction of uploads to fail with HTTP 503')
+    parser.add_argument('--check', action='store_true',
+                        help='check the log for duplicates and gaps, and exit')
+    parser.add_argument('--interval', type=float, default=300,
+                        help='sample interval the node uses (for --check)')
+    args = parser.parse_args()
+
+    if args.check:
+        sys.exit(0 if check(args.log, args.interval) else 1)
+
+    AIOHandler.log_file = args.log
+    AIOHandler.fail_rate = args.fail_rate
+    server = ThreadingHTTPServer(('', args.port), AIOHandler)
+    print(f'listening on port {args.port}, logging to {args.log}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+#! /usr/bin/python3
+
+##
+## Energy model and battery-life predictor for the sensor node
+## (prototype.py) and the e-ink display (eink-display.py).
+##
+## Node: the measured phase timings of a wake cycle (the Wake-Profile feed
+## summary, e.g. 'n=24 i2c=31/40 sht30=16/16 ... publish=22/40 sleep=...')
+## times the current drawn in each phase, plus deep sleep for the rest of
+## the interval.  With batching, the network phases only happen every
+## BATCH_WAKES wakes.  Display: always on, plus the e-ink refreshes.
+##
+## --charge checks the model against a Battery-Charge series exported from
+## Adafruit IO (CSV or JSON with created_at and value): the observed drain
+## rate is compared with the prediction for the settings given.
+##
+## Usage:
+##   ./host_energy.py node --profile 'n=24 i2c=31/40 ...' --intvl 60,300,900
+##   ./host_energy.py node --batt 400,3000 --batch 1,12
+##   ./host_energy.py node --charge battery-charge.csv --intvl 300
+##   ./host_energy.py display --refresh 60,300,900
+##
+
+import csv
+import json
+import calendar
+import argparse
+import time
+
+
+# current draw (mA) per board and state; 'wifi' is on top of 'cpu'
+BOARDS = {
+    # Feather ESP32-S2 with the BME280, SHT30 and LC709203F: sensor node
+    'feather-s2': {'cpu': 25.0, 'wifi': 95.0, 'sleep': 0.08},
+    # Feather ESP32-S3 with the 2.13" tri-color e-ink FeatherWing: display
+    # (wifi: average with the modem sleeping between MQTT packets)
+    'feather-s3-eink': {'cpu': 32.0, 'wifi': 20.0, 'eink': 9.0,
+                        'sleep': 0.1},
+}
+
+# which states each of PhaseTimer's phases (prototype.py) draws
+PHASE_STATES = {
+    'i2c': ('cpu',),
+    'sht30': ('cpu',),
+    'bme280': ('cpu',),
+    'batt': ('cpu',),
+    'wifi': ('cpu', 'wifi'),
+    'mqtt': ('cpu', 'wifi'),
+    'publish': ('cpu', 'wifi'),
+}
+NETWORK_PHASES = ('wifi', 'mqtt', 'publish')
+
+# wake-up to code.py (not in the profile), all CPU
+BOOT_SECS = 0.6
+# e-ink refresh (tri-color SSD1680, full waveform)
+EINK_REFRESH_SECS = 15
+
+# fraction of the rated capacity we get before the brown-out
+USABLE = 0.85
+
+# a typical summary, from a 5-minute node with fast reconnect
+DEFAULT_PROFILE = ('n=24 i2c=31/40 sht30=16/16 bme280=2/3 batt=3/4 '
+                   'wifi=310/1900 mqtt=400/480 publish=22/40')
+
+
+def parse_profile(summary):
+    """Wake-Profile summary -> {phase: mean seconds}"""
+    phases = {}
+    for item in summary.split():
+        name, _, value = item.partition('=')
+        if name in PHASE_STATES:
+            phases[name] = int(value.split('/')[0]) / 1000
+    return phases
+
+
+def node_current(phases, intvl, board='feather-s2', batch_wakes=1):
+    """Average current (mA) of the node waking every intvl seconds"""
+    amps = BOARDS[board]
+    charge = BOOT_SECS * amps['cpu']         # mA*s per wake
+    awake = BOOT_SECS
+    for phase, secs in phases.items():
+        if phase in NETWORK_PHASES:
+            secs /= batch_wakes
+        charge += secs * sum(amps[s] for s in PHASE_STATES[phase])
+        awake += secs
+    charge += max(intvl - awake, 0) * amps['sleep']
+    return charge / intvl
+
+
+def display_current(refresh_intvl, board='feather-s3-eink'):
+    """Average current (mA) of eink-display.py refreshing every
+    refresh_intvl seconds"""
+    amps = BOARDS[board]
+    return (amps['cpu'] + amps['wifi'] +
+            amps['eink'] * min(EINK_REFRESH_SECS / refresh_intvl, 1))
+
+
+def life_days(current_ma, mah):
+    return USABLE * mah / current_ma / 24
+
+
+def _parse_time(text):
+    text = text.strip().replace(' UTC', 'Z').replace(' ', 'T')
+    return calendar.timegm(time.strptime(text[:19], '%Y-%m-%dT%H:%M:%S'))
+
+
+def load_series(fname):
+    """(time, value) points from an Adafruit IO feed export, oldest first"""
+    with open(fname) as f:
+        if fname.endswith('.json'):
+            rows = json.load(f)
+        else:
+            rows = list(csv.DictReader(f))
+    return sorted((_parse_time(row['created_at']), float(row['value']))
+                  for row in rows)
+
+
+def drain_rate(series, recharge=5.0):
+    """Least-squares slope (%/day) of the charge since the last recharge
+    (a jump up of more than recharge %).  Returns (slope, days, points)."""
+    start = 0
+    for i in range(1, len(series)):
+        if series[i][1] - series[i - 1][1] > recharge:
+            start = i
+    points = series[start:]
+    if len(points) < 2:
+        raise ValueError('not enough points since the last recharge')
+    n = len(points)
+    mt = sum(t for t, v in points) / n
+    mv = sum(v for t, v in points) / n
+    num = sum((t - mt) * (v - mv) for t, v in points)
+    den = sum((t - mt) ** 2 for t, v in points)
+    return num / den * 86400, (points[-1][0] - points[0][0]) / 86400, n
+
+
+def _values(text, kind=int):
+    return [kind(v) for v in text.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Predict battery life from phase timings and currents')
+    parser.add_argument('target', choices=['node', 'display'])
+    parser.add_argument('--profile', default=DEFAULT_PROFILE,
+                        help='Wake-Profile summary to use for the node')
+    parser.add_argument('--intvl', default='60,300,900',
+                        help='UPDATE_INTVL values (s) for the node')
+    parser.add_argument('--batch', default='1,12',
+                        help='BATCH_WAKES values for the node')
+    parser.add_argument('--refresh', default='60,300,900',
+                        help='REFRESH_INTVL values (s) for the display')
+    parser.add_argument('--batt', default='400,3000',
+                        help='battery sizes (mAh), as in BATT_SIZE')
+    parser.add_argument('--board',
+                        help=f'current table, one of {", ".join(BOARDS)}')
+    parser.add_argument('--charge', metavar='FILE',
+                        help='Battery-Charge export to check the model '
+                             'against (node, first --intvl/--batch/--batt)')
+    args = parser.parse_args()
+
+    sizes = _values(args.batt)
+    if args.target == 'node':
+        board = args.board or 'feather-s2'
+        phases = parse_profile(args.profile)
+        settings = [(intvl, batch) for batch in _values(args.batch)
+                    for intvl in _values(args.intvl)]
+        print(f'node on {board}: ' +
+              ' '.join(f'{p}={s * 1000:.0f}ms' for p, s in phases.items()))
+        print(f'{"intvl":>6s} {"batch":>5s} {"avg mA":>8s} '
+              + ' '.join(f'{f"{mah}mAh days":>12s}' for mah in sizes))
+        for intvl, batch in settings:
+            ma = node_current(phases, intvl, board, batch)
+            print(f'{intvl:6d} {batch:5d} {ma:8.3f} ' +
+                  ' '.join(f'{life_days(ma, mah):12.1f}' for mah in sizes))
+
+        if args.charge:
+            intvl, batch = settings[0]
+            mah = sizes[0]
+            ma = node_current(phases, intvl, board, batch)
+            predicted = -100 * ma * 24 / (USABLE * mah)
+            slope, days, n = drain_rate(load_series(args.charge))
+            print(f'\nBattery-Charge: {n} points over {days:.1f} days, '
+                  f'{slope:.2f} %/day')
+            print(f'model ({intvl} s, batch {batch}, {mah} mAh): '
+                  f'{predicted:.2f} %/day')
+            print(f'observed/model: {slope / predicted:.2f} '
+                  f'(observed average {ma * slope / predicted:.3f} mA)')
+    else:
+        board = args.board or 'feather-s3-eink'
+        print(f'display on {board}')
+        print(f'{"refresh":>7s} {"avg mA":>8s} '
+              + ' '.join(f'{f"{mah}mAh days":>12s}' for mah in sizes))
+        for refresh in _values(args.refresh):
+            ma = display_current(refresh, board)
+            print(f'{refresh:7d} {ma:8.2f} ' +
+                  ' '.join(f'{life_days(ma, mah):12.2f}' for mah in sizes))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,590 @@
+#! /usr/bin/python3
+
+##
+## Headless displayio renderer: run the display code from the CircuitPython
+## scripts on the devel host (not CircuitPython), composite the displayio
+## tree into a NumPy framebuffer and report what each frame costs.
+##
+## Uses the Blinka displayio port plus the real adafruit_bitmap_font and
+## adafruit_display_text libraries, so the fonts in fonts/ render exactly
+## as they do on the board.  Install with:  uv sync --group host
+##
+## Usage:
+##   ./host_render.py                      # benchmark all targets
+##   ./host_render.py eink-display --frames 50 --png /tmp/frames
+##
+
+import gc
+import os
+import sys
+import json
+import time
+import tracemalloc
+import types
+import ast
+import argparse
+import importlib
+import importlib.util
+from collections import namedtuple
+
+import numpy as np
+
+
+# CircuitPython core modules that only exist on the board: always replaced
+HARDWARE_MODULES = (
+    'alarm', 'board', 'keypad', 'microcontroller', 'rtc', 'socketpool', 'wifi',
+)
+# libraries the scripts import: use the real one if installed, else replace
+LIBRARY_MODULES = (
+    'adafruit_logging',
+    'adafruit_ntp',
+    'adafruit_requests',
+    'adafruit_connection_manager',
+    'adafruit_minimqtt', 'adafruit_minimqtt.adafruit_minimqtt',
+    'adafruit_io', 'adafruit_io.adafruit_io', 'adafruit_io.adafruit_io_errors',
+    'adafruit_ssd1680',
+    'adafruit_bme280', 'adafruit_bme280.basic',
+    'adafruit_sht31d',
+    'adafruit_lc709203f',
+    'digitalio',
+    'fourwire',
+    'neopixel',
+)
+
+# sample time for the benchmarks (Tue Nov 14 2023 22:13:20 UTC)
+START_TIME = 1700000000
+
+# --soak: heap growth (in allocated blocks) allowed between the first and
+# last sample.  CPython frees a rebuilt tree again each cycle, so this only
+# catches real leaks: a tree rebuilt every cycle shows up in the bytes
+# allocated per cycle (the eink-display tree is ~50 KB, cached ~3 KB), and
+# in the groups no longer being the same objects from cycle to cycle.
+SOAK_LIMIT = 200
+SOAK_CHURN_LIMIT = 8192
+
+RenderStats = namedtuple('RenderStats',
+                         ['render_ms', 'objects', 'bitmap_bytes', 'frame_bytes',
+                          'dirty_bytes'])
+
+
+class _StandIn:
+    """Absorbs attribute access and calls, so that module-level references to
+    hardware (board.D9, PackSize.MAH3000, ...) resolve on the host."""
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        return _StandIn(f'{self._name}.{attr}')
+
+    def __call__(self, *args, **kwargs):
+        return _StandIn(f'{self._name}()')
+
+    def __repr__(self):
+        return f'<stand-in {self._name}>'
+
+
+class _StandInModule(types.ModuleType):
+    def __getattr__(self, attr):
+        if attr.startswith('__'):
+            raise AttributeError(attr)
+        return _StandIn(f'{self.__name__}.{attr}')
+
+
+def _install_stand_in(name):
+    module = _StandInModule(name)
+    sys.modules[name] = module
+    parent, _, child = name.rpartition('.')
+    if parent:
+        if parent not in sys.modules:
+            _install_stand_in(parent)
+        setattr(sys.modules[parent], child, module)
+
+
+def install_stand_ins():
+    """Make the board-only imports of the CircuitPython scripts resolvable"""
+    for name in HARDWARE_MODULES:
+        if name not in sys.modules:
+            _install_stand_in(name)
+    for name in LIBRARY_MODULES:
+        if name in sys.modules:
+            continue
+        try:
+            importlib.import_module(name)
+        except Exception:
+            _install_stand_in(name)
+
+
+def load_script(fname):
+    """Import one of the (hyphenated) scripts as a module, without running
+    its __main__ section."""
+    install_stand_ins()
+    name = os.path.splitext(os.path.basename(fname))[0].replace('-', '_')
+    spec = importlib.util.spec_from_file_location(name, fname)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+## displayio compositing
+
+def bitmap_array(bitmap):
+    """Return the values of a displayio Bitmap as an (height, width) array"""
+    width, height = bitmap.width, bitmap.height
+    data = getattr(bitmap, '_data', None)
+    bits = getattr(bitmap, '_bits_per_value', 0)
+    if data is not None and bits in (1, 2, 4):
+        # Blinka packs sub-byte values MSB first into 32-bit words
+        words = np.array(data, dtype=np.uint32).reshape(height, -1)
+        per_word = 32 // bits
+        xs = np.arange(width)
+        shifts = (32 - (xs % per_word + 1) * bits).astype(np.uint32)
+        return (words[:, xs // per_word] >> shifts) & ((1 << bits) - 1)
+    if data is not None and bits in (8, 16, 32):
+        raw = np.frombuffer(memoryview(data).cast('B'), dtype=f'<u{bits // 8}')
+        return raw.reshape(height, -1)[:, :width].astype(np.uint32)
+    # slow path for anything else that supports bitmap[x, y]
+    return np.array([[bitmap[x, y] for x in range(width)]
+                     for y in range(height)], dtype=np.uint32)
+
+
+def bitmap_bytes(bitmap):
+    """Heap used by the pixel storage of a Bitmap (rows are word aligned)"""
+    bits = getattr(bitmap, 'bits_per_value', None) or \
+        getattr(bitmap, '_bits_per_value', 8)
+    return (bitmap.width * bits + 31) // 32 * 4 * bitmap.height
+
+
+def _shade(values, shader):
+    """Map bitmap values through the pixel shader -> (rgb, opaque)"""
+    import displayio
+    if isinstance(shader, displayio.Palette):
+        count = len(shader)
+        colors = np.array([shader[i] or 0 for i in range(count)], dtype=np.uint32)
+        opaque = np.array([not shader.is_transparent(i) for i in range(count)])
+        # out-of-range values are drawn as transparent, same as displayio
+        valid = values < count
+        index = np.where(valid, values, 0)
+        colors = colors[index]
+        mask = opaque[index] & valid
+    else:
+        # ColorConverter: the bitmap already holds RGB888 values
+        colors = values
+        mask = np.ones(values.shape, dtype=bool)
+    rgb = np.stack([(colors >> 16) & 0xFF, (colors >> 8) & 0xFF, colors & 0xFF],
+                   axis=-1).astype(np.uint8)
+    return rgb, mask
+
+
+def _tilegrid_values(tg):
+    values = bitmap_array(tg.bitmap)
+    tw, th = tg.tile_width, tg.tile_height
+    per_row = tg.bitmap.width // tw
+    # the display_shapes classes override width/height with pixel sizes
+    width = getattr(tg, '_width_in_tiles', tg.width)
+    height = getattr(tg, '_height_in_tiles', tg.height)
+    rows = []
+    for ty in range(height):
+        row = []
+        for tx in range(width):
+            tile = tg[tx, ty]
+            sx = (tile % per_row) * tw
+            sy = (tile // per_row) * th
+            row.append(values[sy:sy+th, sx:sx+tw])
+        rows.append(np.hstack(row))
+    values = np.vstack(rows)
+    if tg.transpose_xy:
+        values = values.T
+    if tg.flip_x:
+        values = values[:, ::-1]
+    if tg.flip_y:
+        values = values[::-1, :]
+    return values
+
+
+def _blit(frame, rgb, mask, x, y):
+    height, width = frame.shape[:2]
+    h, w = mask.shape
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + w, width), min(y + h, height)
+    if x0 >= x1 or y0 >= y1:
+        return
+    src = (slice(y0 - y, y1 - y), slice(x0 - x, x1 - x))
+    dst = frame[y0:y1, x0:x1]
+    m = mask[src]
+    dst[m] = rgb[src][m]
+
+
+def _render(layer, frame, x, y, scale, stats):
+    import displayio
+    if layer.hidden:
+        return
+    stats['objects'] += 1
+    if isinstance(layer, displayio.Group):
+        x += layer.x * scale
+        y += layer.y * scale
+        scale *= layer.scale
+        for child in layer:
+            _render(child, frame, x, y, scale, stats)
+    elif isinstance(layer, displayio.TileGrid):
+        bitmap = layer.bitmap
+        if id(bitmap) not in stats['bitmaps']:
+            stats['bitmaps'].add(id(bitmap))
+            stats['bitmap_bytes'] += bitmap_bytes(bitmap)
+        values = _tilegrid_values(layer)
+        if scale > 1:
+            values = values.repeat(scale, axis=0).repeat(scale, axis=1)
+        rgb, mask = _shade(values, layer.pixel_shader)
+        _blit(frame, rgb, mask, x + layer.x * scale, y + layer.y * scale)
+
+
+def changed_box(prev, frame):
+    """Bounding box (x, y, w, h) of the pixels that differ, or None"""
+    diff = np.any(prev != frame, axis=-1)
+    rows = np.flatnonzero(diff.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(diff.any(axis=0))
+    return (cols[0], rows[0], cols[-1] - cols[0] + 1, rows[-1] - rows[0] + 1)
+
+
+def composite(group, frame):
+    """Draw a displayio tree into frame (an (h, w, 3) uint8 array).
+    Returns (number of visible objects, bytes held in their bitmaps)."""
+    stats = {'objects': 0, 'bitmap_bytes': 0, 'bitmaps': set()}
+    if group is not None:
+        _render(group, frame, 0, 0, 1, stats)
+    return stats['objects'], stats['bitmap_bytes']
+
+
+class HostDisplay:
+    """Stands in for board.DISPLAY or an EPaperDisplay: refresh() composites
+    root_group into a NumPy framebuffer and records a RenderStats.
+
+    dirty_bytes is what a windowed (partial) update would have to send: the
+    bounding box of the pixels that changed since the previous frame."""
+    def __init__(self, width, height, *, bits_per_pixel=16, bg_color=0x000000,
+                 render=True):
+        self.width = width
+        self.height = height
+        self.bits_per_pixel = bits_per_pixel
+        self.bg_color = bg_color
+        # render=False: only run the script side (used by the soak test)
+        self.render = render
+        self.root_group = None
+        self.busy = False
+        self.time_to_refresh = 0
+        self.frame = np.zeros((height, width, 3), dtype=np.uint8)
+        self.prev_frame = None
+        self.stats = []
+
+    @property
+    def frame_bytes(self):
+        """Bytes the display driver has to push for one full frame"""
+        return self.width * self.height * self.bits_per_pixel // 8
+
+    def show(self, group):
+        # pre-CP 9.0 API, still used by eink-weather.py
+        self.root_group = group
+
+    def update_refresh_mode(self, start_sequence, seconds_per_frame):
+        self.time_to_refresh = 0
+
+    def refresh(self):
+        if not self.render:
+            return True
+        self.prev_frame = self.frame.copy()
+        t0 = time.perf_counter_ns()
+        self.frame[:] = [(self.bg_color >> 16) & 0xFF,
+                         (self.bg_color >> 8) & 0xFF,
+                         self.bg_color & 0xFF]
+        objects, nbytes = composite(self.root_group, self.frame)
+        render_ms = (time.perf_counter_ns() - t0) / 1e6
+        if len(self.stats) == 0:
+            dirty_bytes = self.frame_bytes
+        else:
+            box = changed_box(self.prev_frame, self.frame)
+            dirty_bytes = 0
+            if box:
+                dirty_bytes = box[2] * box[3] * self.bits_per_pixel // 8
+        self.stats.append(RenderStats(render_ms, objects, nbytes,
+                                      self.frame_bytes, dirty_bytes))
+        return True
+
+    def save_png(self, fname):
+        from PIL import Image
+        Image.fromarray(self.frame, 'RGB').save(fname)
+
+
+## benchmark targets: each setup returns an update(i) that draws frame i
+
+def setup_eink_display(mod, display):
+    gfx = mod.MyGraphics(celsius=False, tz_offset=mod.LOCAL_TZ_HOURS*3600)
+
+    def update(i):
+        vals = {'seconds': START_TIME + i * mod.REFRESH_INTVL,
+                'alt-temp': 58.0 + (i % 50) * 0.7,
+                'alt-humidity': 45.0 + (i % 20) * 2.5,
+                'pressure': 29.92 + (i % 7) * 0.05,
+                'battery-charge': 100.0 - (i % 100)}
+        gfx.update_values(vals)
+        display.root_group = gfx.get_display_group(mod.DISPLAY_WIDTH,
+                                                   mod.DISPLAY_HEIGHT)
+        display.refresh()
+    return update
+
+
+def setup_eink_weather(mod, display):
+    gfx = mod.Weather_Graphics(celsius=False, am_pm=True)
+    owm_data = mod.dummy_data
+
+    def update(i):
+        gfx.update_weather(owm_data)
+        gfx.update_time(owm_data['dt'] + i * 300, owm_data['timezone'])
+        display.root_group = gfx.get_display_group(mod.DISPLAY_WIDTH,
+                                                   mod.DISPLAY_HEIGHT)
+        display.refresh()
+    return update
+
+
+def setup_display_clock(mod, display):
+    disp = mod.MyDisplay(display, mod.LARGE_FONT, mod.ColorSelect())
+
+    def update(i):
+        # MyDisplay.update_text() does its own display.refresh()
+        disp.update_text(mod.get_time_string(time.gmtime(START_TIME + i)))
+    return update
+
+
+def setup_display_ledclock(mod, display):
+    digit_disps = mod.build_display(display)
+    shown = ['']
+
+    def update(i):
+        # only the digits that changed get redrawn, like main() does
+        shown[0] = mod.show_time(digit_disps, time.gmtime(START_TIME + i),
+                                 shown[0])
+        display.refresh()
+    return update
+
+
+# name: (script, width, height, bits per pixel, background, setup)
+TARGETS = {
+    # SSD1680 tri-color: one black and one red bit-plane
+    'eink-display': ('eink-display.py', 250, 122, 2, 0xFFFFFF,
+                     setup_eink_display),
+    'eink-weather': ('eink-weather.py', 250, 122, 2, 0xFFFFFF,
+                     setup_eink_weather),
+    # Feather S2 Reverse-TFT, RGB565
+    'display-clock': ('display-clock.py', 240, 135, 16, 0x000000,
+                      setup_display_clock),
+    # LilyGo T-Display S3, RGB565
+    'display-ledclock': ('display-ledclock.py', 320, 170, 16, 0x000000,
+                         setup_display_ledclock),
+}
+
+
+def run_target(name, frames, png_dir=None, settings={}):
+    """Draw frames of one target, returns [(update_ms, RenderStats), ...]"""
+    script, width, height, bpp, bg, setup = TARGETS[name]
+    mod = load_script(script)
+    # override config knobs (CACHE_GROUPS, PARTIAL_REFRESH, ...) if present
+    for knob, value in settings.items():
+        if hasattr(mod, knob):
+            setattr(mod, knob, value)
+    display = HostDisplay(width, height, bits_per_pixel=bpp, bg_color=bg)
+    update = setup(mod, display)
+
+    results = []
+    for i in range(frames):
+        t0 = time.perf_counter_ns()
+        update(i)
+        total_ms = (time.perf_counter_ns() - t0) / 1e6
+        stats = display.stats[-1]
+        # time spent in the script itself (building/updating the group)
+        results.append((total_ms - stats.render_ms, stats))
+        if png_dir:
+            display.save_png(os.path.join(png_dir, f'{name}-{i:03d}.png'))
+    return results
+
+
+def display_groups(group):
+    """The Groups (labels included) of a displayio tree, depth first"""
+    import displayio
+    groups = []
+    if isinstance(group, displayio.Group):
+        groups.append(group)
+        for child in group:
+            groups.extend(display_groups(child))
+    return groups
+
+
+def soak(name, cycles, settings={}, samples=10):
+    """Run many update cycles of a target without rendering, and sample the
+    heap: with a retained display tree it should stay flat.
+    Returns ([(cycle, live heap blocks), ...], bytes allocated per cycle,
+    number of samples where the tree wasn't the one of the first cycle)"""
+    script, width, height, bpp, bg, setup = TARGETS[name]
+    mod = load_script(script)
+    for knob, value in settings.items():
+        if hasattr(mod, knob):
+            setattr(mod, knob, value)
+    display = HostDisplay(width, height, bits_per_pixel=bpp, bg_color=bg,
+                          render=False)
+    update = setup(mod, display)
+    # warm up caches (fonts, glyphs) before the first sample
+    for i in range(10):
+        update(i)
+
+    # tracemalloc is too slow to leave on for the whole run: use it on a
+    # few cycles to see how much each one allocates (and frees again)
+    tracemalloc.start()
+    churn = 0
+    for i in range(samples):
+        before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        update(10 + i)
+        churn = max(churn, tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+
+    retained = display_groups(display.root_group)
+    rebuilt = 0
+    every = max(cycles // samples, 1)
+    results = []
+    for i in range(cycles):
+        update(10 + samples + i)
+        if (i + 1) % every == 0:
+            groups = display_groups(display.root_group)
+            if ( len(groups) != len(retained) or
+                 any(a is not b for a, b in zip(groups, retained)) ):
+                rebuilt += 1
+            gc.collect()
+            results.append((i + 1, sys.getallocatedblocks()))
+    return results, churn, rebuilt
+
+
+def check_weather_parse():
+    """Feed eink-weather.py's parse_weather() the dummy OWM response, whole
+    and cut short at every byte: a whole one has to give the same fields as
+    json.loads(), a short one either all of them or ValueError (and then
+    WeatherCache has to keep the last good data, marked stale).
+    Returns a list of the problems found."""
+    mod = load_script('eink-weather.py')
+    body = mod.dummy_response.encode()
+    chunk = mod.READ_CHUNK
+    full = json.loads(body)
+    problems = []
+
+    def chunks(data):
+        return [data[i:i + chunk] for i in range(0, len(data), chunk)]
+
+    result = mod.parse_weather(chunks(body))
+    for path in mod.OWM_FIELDS:
+        want = full
+        got = result
+        for key in path.replace('[', '.').replace(']', '').split('.'):
+            key = int(key) if key.isdigit() else key
+            want = want[key]
+            got = got[key]
+        if got != want:
+            problems.append(f'{path}: {got!r}, not {want!r}')
+
+    for cut in range(len(body)):
+        try:
+            short = mod.parse_weather(chunks(body[:cut]))
+        except ValueError:
+            continue
+        if short != result:
+            problems.append(f'cut at {cut} bytes: partial result {short}')
+
+    responses = iter([body, body[:len(body) // 2]])
+    cache = mod.WeatherCache(
+        fetch=lambda: mod.parse_weather(chunks(next(responses))))
+    good = cache.get()
+    if cache.get(ahead=cache.ttl) is not good or not cache.stale:
+        problems.append('WeatherCache replaced the data with a short response')
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Render the display scripts headless and profile them')
+    parser.add_argument('targets', nargs='*', metavar='target',
+                        help=f'one of {", ".join(TARGETS)} (default: all)')
+    parser.add_argument('--frames', type=int, default=20,
+                        help='frames to draw per target')
+    parser.add_argument('--png', metavar='DIR',
+                        help='dump every frame as a PNG into DIR')
+    parser.add_argument('--set', metavar='KNOB=VALUE', action='append',
+                        default=[],
+                        help='override a config knob of the scripts, '
+                             'e.g. --set PARTIAL_REFRESH=True')
+    parser.add_argument('--soak', metavar='CYCLES', type=int,
+                        help='instead of the benchmark, run CYCLES updates and '
+                             'check that heap use stays flat and the display '
+                             'tree is retained')
+    parser.add_argument('--check-weather', action='store_true',
+                        help="instead of the benchmark, check eink-weather's "
+                             'parsing of whole and cut-short OWM responses')
+    args = parser.parse_args()
+    for name in args.targets:
+        if name not in TARGETS:
+            parser.error(f'unknown target: {name}')
+    settings = {}
+    for item in args.set:
+        knob, _, value = item.partition('=')
+        settings[knob] = ast.literal_eval(value)
+
+    # (relative to where we were run from, not the chdir below)
+    if args.png:
+        args.png = os.path.abspath(args.png)
+    # the scripts load fonts relative to the CIRCUITPY root
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    if args.png:
+        os.makedirs(args.png, exist_ok=True)
+
+    if args.check_weather:
+        problems = check_weather_parse()
+        for problem in problems:
+            print(problem)
+        print('weather parse: ' + ('FAILED' if problems else 'ok'))
+        sys.exit(1 if problems else 0)
+
+    if args.soak:
+        failed = False
+        for name in args.targets or ['eink-display']:
+            results, churn, rebuilt = soak(name, args.soak, settings)
+            print(f'{name}: {churn} B allocated per cycle')
+            print(f'{"cycle":>8s} {"heap blocks":>12s}')
+            for cycle, blocks in results:
+                print(f'{cycle:8d} {blocks:12d}')
+            growth = results[-1][1] - results[0][1]
+            flat = growth <= SOAK_LIMIT
+            print(f'heap growth {growth} blocks: {"flat" if flat else "GROWING"}')
+            churn_ok = churn <= SOAK_CHURN_LIMIT
+            print(f'allocation per cycle: '
+                  f'{"ok" if churn_ok else f"over {SOAK_CHURN_LIMIT} B"}')
+            print('display tree: ' + (f'rebuilt in {rebuilt} of '
+                                      f'{len(results)} samples'
+                                      if rebuilt else 'retained'))
+            failed = failed or not (flat and churn_ok and not rebuilt)
+        sys.exit(1 if failed else 0)
+
+    print(f'{"target":18s} {"frames":>6s} {"update ms":>10s} {"render ms":>10s}'
+          f' {"objects":>8s} {"bitmap B":>9s} {"frame B":>8s} {"dirty B":>8s}')
+    for name in args.targets or TARGETS:
+        results = run_target(name, args.frames, args.png, settings)
+        update_ms = sum(u for u, s in results) / len(results)
+        render_ms = sum(s.render_ms for u, s in results) / len(results)
+        # average over the updates only, the first frame is always full
+        updates = [s.dirty_bytes for u, s in results[1:]] or [0]
+        dirty = sum(updates) / len(updates)
+        last = results[-1][1]
+        print(f'{name:18s} {len(results):6d} {update_ms:10.2f} {render_ms:10.2f}'
+              f' {last.objects:8d} {last.bitmap_bytes:9d} {last.frame_bytes:8d}'
+              f' {dirty:8.0f}')
+
+
+if __name__ == '__main__':
+    main()
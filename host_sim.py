@@ -0,0 +1,1129 @@
+#! /usr/bin/python3
+
+##
+## Virtual-time simulation of the deep-sleep sensor node (prototype.py) and
+## the e-ink display (eink-display.py) on the devel host.
+##
+## The board modules (alarm, wifi, socketpool, board.I2C, rtc, ...), the
+## sensor drivers, MQTT / Adafruit IO and the REST API are replaced by
+## models that run on a virtual clock: time.sleep(), Wi-Fi association,
+## DHCP, MQTT round trips and deep sleep just move the clock, so a month of
+## 5-minute wake cycles runs in seconds.  Failures can be injected with
+## --fail KIND=P (probability per attempt):
+##
+##   wifi   association fails            dns    lookup fails
+##   mqtt   broker refuses the connect   http   REST call gets a 503
+##   drop   MQTT connection dies (P per hour connected)
+##   ap     Wi-Fi association is lost (P per hour connected)
+##   move   broker changes address (P per wake)
+##
+## Usage:
+##   ./host_sim.py node --days 30 --fail wifi=0.05 --fail mqtt=0.02
+##   ./host_sim.py node --days 30 --set BATCH_WAKES=12 --fail http=0.2
+##   ./host_sim.py display --days 7 --fail drop=0.1
+##
+## The battery model uses host_energy.py's current table; --export writes
+## the feeds (e.g. battery-charge) out to check host_energy's fit against.
+##
+
+import os
+import re
+import sys
+import ast
+import json
+import math
+import time
+import types
+import random
+import calendar
+import asyncio
+import argparse
+import struct
+import selectors
+import contextlib
+import ipaddress
+from collections import Counter, defaultdict
+from urllib.parse import urlparse
+
+import adafruit_logging
+
+from host_render import HostDisplay, _StandInModule, START_TIME
+from host_energy import BOARDS, BOOT_SECS, EINK_REFRESH_SECS, USABLE
+
+
+# what the board's RTC says before anyone sets it: 2000-01-01
+RTC_EPOCH = 946684800
+SLEEP_MEMORY_SIZE = 8192
+
+# rough latencies on the virtual clock (seconds)
+SCAN_ASSOC_SECS = 1.8       # scan all channels + associate
+FAST_ASSOC_SECS = 0.3       # associate with a known channel/BSSID
+DHCP_SECS = 0.9
+WIFI_TIMEOUT = 10
+DNS_SECS = 0.08
+MQTT_CONNECT_SECS = 0.4
+MQTT_PUBLISH_SECS = 0.02
+HTTP_SECS = 0.35
+
+# current draw of the sensor node (mA) for the battery model
+NODE_BOARD = BOARDS['feather-s2']
+
+# what the display sees from the (simulated) sensor node
+NODE_PUBLISH_INTVL = 300
+
+AP_BSSID = bytes.fromhex('b0be76a1c2d3')
+AP_CHANNEL = 6
+LEASE = ('192.168.1.57', '255.255.255.0', '192.168.1.1', '192.168.1.1')
+BROKER_ADDRS = ['52.70.203.194', '52.54.163.195', '34.234.120.82']
+
+FAULTS = ('wifi', 'dns', 'mqtt', 'http', 'drop', 'ap', 'move')
+
+
+class DeepSleep(BaseException):
+    """alarm.exit_and_deep_sleep_until_alarms(): ends this run of the script
+    (BaseException, so the scripts' "except Exception" don't catch it)"""
+    def __init__(self, until):
+        super().__init__(until)
+        self.until = until
+
+
+class SimEnd(BaseException):
+    """Raised from the virtual clock when the simulated time is up"""
+
+
+## virtual time
+
+class VirtualClock:
+    def __init__(self):
+        self.mono = 0.0
+        # board RTC = rtc_base + mono, until rtc.RTC().datetime is set
+        self.rtc_base = RTC_EPOCH
+        # raise SimEnd once mono passes this (None: never)
+        self.limit = None
+
+    def advance(self, secs):
+        self.mono += secs
+        if self.limit is not None and self.mono >= self.limit:
+            raise SimEnd()
+
+    def rtc(self):
+        return self.rtc_base + self.mono
+
+    def set_rtc(self, secs):
+        self.rtc_base = secs - self.mono
+
+    def true_time(self):
+        """Real-world (UTC) time, for the network services"""
+        return START_TIME + self.mono
+
+    def module(self):
+        """A time module for the scripts, driven by this clock"""
+        mod = types.ModuleType('time')
+        mod.monotonic = lambda: self.mono
+        mod.monotonic_ns = lambda: int(self.mono * 1e9)
+        mod.time = lambda: int(self.rtc())
+        # CircuitPython has no time zones: localtime() is the RTC's time
+        mod.localtime = lambda secs=None: time.gmtime(
+            self.rtc() if secs is None else secs)
+        mod.gmtime = mod.localtime
+        mod.mktime = calendar.timegm
+        mod.sleep = self.advance
+        mod.struct_time = time.struct_time
+        # anything else (perf_counter, ...) is the host's
+        mod.__getattr__ = lambda attr: getattr(time, attr)
+        return mod
+
+    def asyncio_module(self):
+        """An asyncio module for the scripts whose run() uses an event
+        loop on this clock"""
+        clock = self
+
+        def run(main):
+            loop = VirtualEventLoop(clock)
+            try:
+                return loop.run_until_complete(main)
+            finally:
+                # let the cancelled tasks finish, even past the end
+                pending = asyncio.all_tasks(loop)
+                for task in pending:
+                    task.cancel()
+                limit, clock.limit = clock.limit, None
+                try:
+                    if pending:
+                        loop.run_until_complete(
+                            asyncio.gather(*pending, return_exceptions=True))
+                finally:
+                    clock.limit = limit
+                    loop.close()
+
+        mod = types.ModuleType('asyncio')
+        mod.run = run
+        # create_task, sleep, Event, ... are the host's
+        mod.__getattr__ = lambda attr: getattr(asyncio, attr)
+        return mod
+
+
+class VirtualSelector(selectors.SelectSelector):
+    """The scripts' event loops only wait on timers: select() just moves
+    the clock on"""
+    def __init__(self, clock):
+        super().__init__()
+        self.clock = clock
+
+    def select(self, timeout=None):
+        if timeout is None:
+            raise RuntimeError('event loop would wait forever')
+        self.clock.advance(timeout)
+        return []
+
+
+class VirtualEventLoop(asyncio.SelectorEventLoop):
+    def __init__(self, clock):
+        super().__init__(VirtualSelector(clock))
+        self.clock = clock
+
+    def time(self):
+        return self.clock.mono
+
+
+## the world outside the board
+
+class Weather:
+    """Smooth daily swings plus a few-day front, with a little noise"""
+    def __init__(self, rng):
+        self.rng = rng
+
+    def __call__(self, t):
+        day = 2 * math.pi * t / 86400
+        front = 2 * math.pi * t / (4.7 * 86400)
+        noise = self.rng.gauss
+        temp_C = 13 + 6 * math.sin(day - 2.0) + 3 * math.sin(front) \
+            + noise(0, 0.03)
+        humidity = 62 - 18 * math.sin(day - 2.0) + noise(0, 0.2)
+        pressure = 1013 + 8 * math.sin(front + 1.0) + noise(0, 0.05)
+        return temp_C, min(max(humidity, 0), 100), pressure
+
+
+class Battery:
+    def __init__(self, mah=3000):
+        self.mah = mah
+        self.used = 0.0
+
+    def drain(self, ma, secs):
+        self.used += ma * secs / 3600
+
+    @property
+    def percent(self):
+        # the gauge reads 0% at the brown-out, not when it's really empty
+        return max(100 * (1 - self.used / (USABLE * self.mah)), 0.0)
+
+    @property
+    def voltage(self):
+        return 3.3 + 0.9 * self.percent / 100
+
+
+class Sim:
+    """Shared state of the models: clock, faults, counters, what the
+    broker/server received"""
+    def __init__(self, days, faults, seed=0):
+        self.clock = VirtualClock()
+        self.end = days * 86400
+        self.faults = faults
+        self.rng = random.Random(seed)
+        self.weather = Weather(random.Random(seed + 1))
+        self.battery = Battery()
+        self.sleep_memory = bytearray(SLEEP_MEMORY_SIZE)
+        self.stats = Counter()
+        self.broker_addr = BROKER_ADDRS[0]
+        # feed -> [(time, value)] as received by the broker/server
+        self.points = defaultdict(list)
+        self.radio = SimRadio(self)
+        self.i2c = SimI2C(self)
+        self.wake_start = 0.0
+        self.attempted = self.delivered = False
+        self.awake_max = 0.0
+        # longest the display left the MQTT connection unserviced
+        self.mqtt_max_gap = 0.0
+        # the node publishes halfway through each interval (as seen from
+        # the display), and when the display first got (and refreshed
+        # with) its values
+        self.next_node_publish = START_TIME + NODE_PUBLISH_INTVL / 2
+        self.first_values = None
+        self.first_useful_refresh = None
+
+    def fail(self, kind, hours=None):
+        p = self.faults.get(kind, 0.0)
+        if hours is not None:
+            p = 1 - (1 - p) ** hours
+        return p > 0 and self.rng.random() < p
+
+    def deliver(self, feed, value, t=None):
+        self.points[feed].append((self.clock.true_time() if t is None else t,
+                                  value))
+        self.delivered = True
+
+    def sample(self):
+        return self.weather(self.clock.true_time())
+
+    def node_feeds(self):
+        """What the node publishes to the Porch group, as of now"""
+        temp_C, humidity, pressure = self.sample()
+        return {'alt-temp': round(temp_C * 9 / 5 + 32, 2),
+                'alt-humidity': round(humidity, 2),
+                'pressure': round(pressure / 33.8638864, 3),
+                'battery-charge': 87.5}
+
+    def display_got_values(self):
+        if self.first_values is None:
+            self.first_values = self.clock.mono
+
+    ## sensor node wake cycles
+
+    def boot(self):
+        self.stats['wakes'] += 1
+        self.wake_start = self.clock.mono
+        self.attempted = self.delivered = False
+        self.radio.reset()
+        if self.fail('move'):
+            self.broker_addr = self.rng.choice(
+                [a for a in BROKER_ADDRS if a != self.broker_addr])
+        self.clock.advance(BOOT_SECS)
+
+    def deep_sleep(self, until):
+        now = self.clock.mono
+        awake = now - self.wake_start
+        self.stats['awake secs'] += awake
+        self.awake_max = max(self.awake_max, awake)
+        self.battery.drain(NODE_BOARD['cpu'], awake)
+        if self.radio.on_since is not None:
+            radio = now - self.radio.on_since
+            self.stats['radio secs'] += radio
+            self.battery.drain(NODE_BOARD['wifi'], radio)
+        if self.delivered:
+            self.stats['publishes ok'] += 1
+        elif self.attempted:
+            self.stats['publishes failed'] += 1
+        else:
+            self.stats['offline wakes'] += 1
+        until = max(until, now)
+        self.battery.drain(NODE_BOARD['sleep'], until - now)
+        self.clock.mono = until
+
+
+## board / driver models
+
+class SimRadio:
+    """wifi.radio"""
+    def __init__(self, sim):
+        self.sim = sim
+        self.mac_address = bytes.fromhex('7cdfa1000001')
+        self.reset()
+
+    def reset(self):
+        # state that doesn't survive deep sleep
+        self.hostname = None
+        self._enabled = True
+        self.connected = False
+        self.static = False
+        self.on_since = None
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    @enabled.setter
+    def enabled(self, value):
+        self._enabled = value
+        if not value:
+            self.connected = False
+
+    @property
+    def ap_info(self):
+        if not self.connected:
+            return None
+        return types.SimpleNamespace(ssid='porch', bssid=AP_BSSID,
+                                     channel=AP_CHANNEL, rssi=-61)
+
+    def _addr(self, i):
+        return ipaddress.IPv4Address(LEASE[i]) if self.connected else None
+
+    ipv4_address = property(lambda self: self._addr(0))
+    ipv4_subnet = property(lambda self: self._addr(1))
+    ipv4_gateway = property(lambda self: self._addr(2))
+    ipv4_dns = property(lambda self: self._addr(3))
+
+    def set_ipv4_address(self, *, ipv4, netmask, gateway, ipv4_dns=None):
+        self.static = True
+
+    def start_dhcp(self):
+        self.static = False
+
+    def connect(self, ssid, password, *, channel=0, bssid=None, timeout=None):
+        sim = self.sim
+        sim.attempted = True
+        sim.stats['wifi connects'] += 1
+        if self.on_since is None:
+            self.on_since = sim.clock.mono
+        targeted = bool(channel and bssid)
+        if sim.fail('wifi') or (targeted and (bytes(bssid) != AP_BSSID or
+                                              channel != AP_CHANNEL)):
+            sim.stats['wifi failures'] += 1
+            sim.clock.advance(timeout or WIFI_TIMEOUT)
+            raise ConnectionError('No network with that ssid')
+        sim.clock.advance(FAST_ASSOC_SECS if targeted else SCAN_ASSOC_SECS)
+        if not self.static:
+            sim.clock.advance(DHCP_SECS)
+        sim.stats['wifi fast' if targeted and self.static else 'wifi full'] += 1
+        self.connected = True
+
+
+class SimPool:
+    """socketpool.SocketPool: just DNS"""
+    def __init__(self, radio):
+        self.sim = radio.sim
+
+    def getaddrinfo(self, host, port, *args):
+        sim = self.sim
+        sim.clock.advance(DNS_SECS)
+        sim.stats['dns lookups'] += 1
+        if not sim.radio.connected or sim.fail('dns'):
+            sim.stats['dns failures'] += 1
+            raise OSError(-2, 'Name or service not known')
+        addr = sim.broker_addr if not re.match(r'[\d.]+$', host) else host
+        return [(2, 1, 0, '', (addr, port))]
+
+
+def crc8(data):
+    crc = 0xff
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x31 if crc & 0x80 else crc << 1) & 0xff
+    return crc
+
+
+class SHT30Chip:
+    """Single-shot measurements: reads before they're done get NACKed"""
+    MEASURE_SECS = 0.0155
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.started = None
+
+    def write(self, buf):
+        if bytes(buf[:2]) in (b'\x24\x00', b'\x2c\x06'):
+            self.started = self.sim.clock.mono
+            self.sim.stats['sht30 conversions'] += 1
+
+    def readinto(self, buf):
+        if (self.started is None or
+                self.sim.clock.mono - self.started < self.MEASURE_SECS):
+            raise OSError(19, 'No such device (NACK)')
+        self.started = None
+        temp_C, humidity, _ = self.sim.sample()
+        raw_t = round((temp_C + 45) * 65535 / 175)
+        raw_h = round(humidity * 65535 / 100)
+        data = bytearray()
+        for raw in (raw_t, raw_h):
+            word = bytes(((raw >> 8) & 0xff, raw & 0xff))
+            data += word + bytes((crc8(word),))
+        buf[:6] = data
+
+
+class BME280Chip:
+    """The BME280's registers: calibration, status and the raw readings of
+    a forced-mode conversion, which compensate (with the datasheet's
+    formulas) to the weather model's temperature and pressure"""
+    # dig_T1..dig_P9, the datasheet's example values
+    CALIB = (27504, 26435, -1000, 36477, -10685, 3024, 2855, 140, -7,
+             15500, -14600, 6000)
+    CONVERSION_SECS = 0.0058
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.regs = bytearray(256)
+        self.regs[0x88:0xA0] = struct.pack('<HhhHhhhhhhhh', *self.CALIB)
+        self.regs[0xD0] = 0x60                  # chip id
+        self.pointer = 0
+        self.done_at = None
+
+    @classmethod
+    def compensate(cls, adc_t, adc_p):
+        """(temp C, pressure hPa) of the raw readings"""
+        T1, T2, T3, P1, P2, P3, P4, P5, P6, P7, P8, P9 = cls.CALIB
+        t_fine = ((adc_t / 16384 - T1 / 1024) * T2 +
+                  (adc_t / 131072 - T1 / 8192) ** 2 * T3)
+        v1 = t_fine / 2 - 64000
+        v2 = (v1 * v1 * P6 / 32768 + v1 * P5 * 2) / 4 + P4 * 65536
+        v1 = (1 + (P3 * v1 * v1 / 524288 + P2 * v1) / 524288 / 32768) * P1
+        p = (1048576 - adc_p - v2 / 4096) * 6250 / v1
+        p += (P9 * p * p / 2147483648 + p * P8 / 32768 + P7) / 16
+        return t_fine / 5120, p / 100
+
+    @classmethod
+    def raw(cls, temp_C, pressure):
+        """The raw (20-bit) readings for temp_C and pressure (hPa)"""
+        def solve(f, target, rising):
+            lo, hi = 0, (1 << 20) - 1
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if (f(mid) < target) == rising:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            return lo
+        adc_t = solve(lambda a: cls.compensate(a, 0)[0], temp_C, True)
+        adc_p = solve(lambda a: cls.compensate(adc_t, a)[1], pressure, False)
+        return adc_t, adc_p
+
+    def start(self):
+        self.sim.stats['bme280 conversions'] += 1
+        self.done_at = self.sim.clock.mono + self.CONVERSION_SECS
+        temp_C, _, pressure = self.sim.sample()
+        adc_t, adc_p = self.raw(temp_C, pressure)
+        self.regs[0xF7:0xFD] = bytes((adc_p >> 12, (adc_p >> 4) & 0xff,
+                                      (adc_p & 0xf) << 4, adc_t >> 12,
+                                      (adc_t >> 4) & 0xff, (adc_t & 0xf) << 4))
+
+    def write(self, buf):
+        self.pointer = buf[0]
+        if len(buf) > 1:
+            self.regs[self.pointer] = buf[1]
+            if self.pointer == 0xF4 and buf[1] & 0x03 in (0x01, 0x02):
+                self.start()
+
+    def readinto(self, buf):
+        measuring = (self.done_at is not None and
+                     self.sim.clock.mono < self.done_at)
+        self.regs[0xF3] = 0x08 if measuring else 0
+        buf[:] = self.regs[self.pointer:self.pointer + len(buf)]
+
+
+class SimI2C:
+    """board.I2C(): the SHT30 and BME280 are talked to directly"""
+    def __init__(self, sim):
+        self.sim = sim
+        self.devices = {0x44: SHT30Chip(sim), 0x77: BME280Chip(sim)}
+
+    def try_lock(self):
+        return True
+
+    def unlock(self):
+        pass
+
+    def scan(self):
+        return [0x0b, 0x44, 0x77]
+
+
+class SimI2CDevice:
+    """adafruit_bus_device.i2c_device.I2CDevice"""
+    def __init__(self, i2c, device_address, probe=True):
+        self.i2c = i2c
+        self.device_address = device_address
+        self.chip = i2c.devices[device_address]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def write(self, buf, *, start=0, end=None):
+        self.chip.write(buf[start:end])
+
+    def readinto(self, buf, *, start=0, end=None):
+        self.chip.readinto(buf)
+
+    def write_then_readinto(self, out_buf, in_buf, *, out_start=0,
+                            out_end=None, in_start=0, in_end=None):
+        self.chip.write(out_buf[out_start:out_end])
+        view = memoryview(in_buf)[in_start:in_end]
+        self.chip.readinto(view)
+
+
+class SimSHT31D:
+    """adafruit_sht31d.SHT31D: blocking reads, one measurement each"""
+    def __init__(self, i2c, address=0x44):
+        self.i2c_device = SimI2CDevice(i2c, address)
+        self.serial_number = 0x1a2b3c4d
+        self.mode = self.repeatability = self.clock_stretching = None
+
+    def _measure(self):
+        self.i2c_device.write(b'\x2c\x06')
+        self.i2c_device.i2c.sim.clock.advance(SHT30Chip.MEASURE_SECS)
+        buf = bytearray(6)
+        self.i2c_device.readinto(buf)
+        return (-45 + 175 * ((buf[0] << 8) | buf[1]) / 65535,
+                100 * ((buf[3] << 8) | buf[4]) / 65535)
+
+    @property
+    def temperature(self):
+        return self._measure()[0]
+
+    @property
+    def relative_humidity(self):
+        return self._measure()[1]
+
+
+class SimBME280:
+    """adafruit_bme280.advanced.Adafruit_BME280_I2C, down to the library
+    quirk that reads in forced mode start another conversion"""
+    MODE_SLEEP, MODE_FORCE, MODE_NORMAL = 0x00, 0x01, 0x03
+
+    def __init__(self, sim, address=0x77):
+        self.sim = sim
+        self.chip = sim.i2c.devices[address]
+        self.sea_level_pressure = 1013.25
+        self.overscan_temperature = self.overscan_pressure = 1
+        self.overscan_humidity = 1
+        self.iir_filter = 0
+        self._mode = self.MODE_NORMAL
+
+    @property
+    def mode(self):
+        return self._mode
+
+    @mode.setter
+    def mode(self, value):
+        self._mode = value
+        if value == self.MODE_FORCE:
+            self.chip.start()
+
+    def _read(self, index):
+        if self._mode != self.MODE_NORMAL:
+            self.mode = self.MODE_FORCE
+            self.sim.clock.advance(self.chip.CONVERSION_SECS)
+        return self.sim.sample()[index]
+
+    temperature = property(lambda self: self._read(0))
+    relative_humidity = property(lambda self: self._read(1))
+    pressure = property(lambda self: self._read(2))
+
+
+class SimLC709203F:
+    """adafruit_lc709203f.LC709203F, reading the battery model"""
+    def __init__(self, sim):
+        self.sim = sim
+        self.ic_version = 0x2717
+
+    @property
+    def pack_size(self):
+        return self.sim.battery.mah
+
+    @pack_size.setter
+    def pack_size(self, mah):
+        self.sim.battery.mah = mah
+
+    cell_percent = property(lambda self: self.sim.battery.percent)
+    cell_voltage = property(lambda self: self.sim.battery.voltage)
+
+
+class MMQTTException(Exception):
+    pass
+
+
+class AdafruitIO_MQTTError(Exception):
+    pass
+
+
+class SimIO_MQTT:
+    """adafruit_io.adafruit_io.IO_MQTT (and the MQTT client under it)"""
+    def __init__(self, client):
+        self.client = client
+        self.sim = client.sim
+        self.connected = False
+        self.subscribed = set()
+        self.on_message = None
+        self.last_serviced = None
+
+    def connect(self):
+        sim = self.sim
+        sim.stats['mqtt connects'] += 1
+        sim.clock.advance(MQTT_CONNECT_SECS)
+        broker = self.client.broker
+        if re.match(r'[\d.]+$', broker) and broker != sim.broker_addr:
+            sim.stats['mqtt stale broker'] += 1
+            raise AdafruitIO_MQTTError('Unable to connect to Adafruit IO.')
+        if not sim.radio.connected or sim.fail('mqtt'):
+            sim.stats['mqtt failures'] += 1
+            raise AdafruitIO_MQTTError('Unable to connect to Adafruit IO.')
+        self.connected = True
+        self.last_serviced = sim.clock.mono
+
+    def reconnect(self):
+        self.connect()
+
+    def disconnect(self):
+        self.connected = False
+
+    def is_connected(self):
+        return self.connected
+
+    def _check(self):
+        if not self.connected:
+            raise MMQTTException('MiniMQTT is not connected')
+
+    def publish(self, feed_key, data, metadata=None, shared_user=None,
+                is_group=False):
+        self._check()
+        self.sim.clock.advance(MQTT_PUBLISH_SECS)
+        self.sim.stats['mqtt publishes'] += 1
+        if is_group:
+            for key, value in json.loads(data)['feeds'].items():
+                self.sim.deliver(key, value)
+        else:
+            self.sim.deliver(feed_key.lower(), data)
+
+    def publish_multiple(self, feeds_and_data, timeout=3, is_group=False):
+        for feed_key, data in feeds_and_data:
+            self.publish(feed_key, data, is_group=is_group)
+
+    def subscribe(self, feed_key=None, group_key=None, shared_user=None):
+        self._check()
+        self.subscribed.add(group_key or feed_key)
+
+    def subscribe_to_time(self, time_type):
+        self._check()
+        self.subscribed.add(time_type)
+
+    def loop(self, timeout=1):
+        """Wait timeout (virtual) seconds, then deliver what the broker
+        would have sent meanwhile"""
+        self._check()
+        sim = self.sim
+        sim.mqtt_max_gap = max(sim.mqtt_max_gap,
+                               sim.clock.mono - self.last_serviced)
+        if sim.fail('ap', hours=timeout / 3600):
+            sim.radio.connected = False
+            sim.stats['wifi drops'] += 1
+        if sim.fail('drop', hours=timeout / 3600) or not sim.radio.connected:
+            self.connected = False
+            sim.stats['mqtt drops'] += 1
+            raise MMQTTException('Connection reset by peer')
+        sim.clock.advance(timeout)
+        now = sim.clock.true_time()
+        if 'seconds' in self.subscribed:
+            sim.stats['time messages'] += 1
+            self.on_message(self, 'seconds', str(int(now)))
+        if now >= sim.next_node_publish:
+            sim.next_node_publish += NODE_PUBLISH_INTVL
+            if 'Porch' in self.subscribed:
+                sim.stats['feed messages'] += 1
+                sim.display_got_values()
+                self.on_message(self, 'Porch',
+                                json.dumps({'feeds': sim.node_feeds()}))
+        self.last_serviced = sim.clock.mono
+
+
+class SimResponse:
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class SimSession:
+    """adafruit_requests.Session, talking to a model of the AIO REST API"""
+    def __init__(self, pool, ssl_context=None):
+        self.sim = pool.sim
+
+    def request(self, method, url, json=None, headers=None, **kwargs):
+        sim = self.sim
+        if not sim.radio.connected:
+            raise OSError(113, 'No route to host')
+        sim.clock.advance(HTTP_SECS)
+        sim.stats['http requests'] += 1
+        if sim.fail('http'):
+            sim.stats['http failures'] += 1
+            return SimResponse(503, '{"error": "injected failure"}')
+        path = urlparse(url).path
+        if path == '/api/v2/time/seconds':
+            return SimResponse(200, str(int(sim.clock.true_time())))
+        match = re.match(r'/api/v2/[^/]+/groups/([^/]+)$', path)
+        if method == 'GET' and match:
+            if match.group(1) != 'porch':
+                return SimResponse(404, '{"error": "not found"}')
+            sim.display_got_values()
+            return SimResponse(200, self._porch_group())
+        match = re.match(r'/api/v2/[^/]+/feeds/([^/]+)/data(/batch)?$', path)
+        if method != 'POST' or not match:
+            return SimResponse(404, '{"error": "not found"}')
+        points = json['data'] if match.group(2) else [json]
+        for point in points:
+            t = None
+            if 'created_at' in point:
+                t = calendar.timegm(time.strptime(point['created_at'],
+                                                  '%Y-%m-%dT%H:%M:%SZ'))
+            sim.deliver(match.group(1), point['value'], t)
+        return SimResponse(200, '[]')
+
+    def _porch_group(self):
+        # (request()'s json argument hides the module there)
+        feeds = [{'key': f'porch.{key}', 'last_value': str(value)}
+                 for key, value in self.sim.node_feeds().items()]
+        return json.dumps({'key': 'porch', 'feeds': feeds})
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+
+class SimDisplay(HostDisplay):
+    """The SSD1680: refresh() keeps it busy for EINK_REFRESH_SECS, and, like
+    EPaperDisplay, refuses to refresh sooner than seconds_per_frame after
+    the last refresh."""
+    def __init__(self, sim, width, height, seconds_per_frame=180):
+        super().__init__(width, height, bits_per_pixel=2, bg_color=0xFFFFFF,
+                         render=False)
+        self.sim = sim
+        self.seconds_per_frame = seconds_per_frame
+        self.busy_until = 0.0
+        self.last_refresh = None
+
+    @property
+    def busy(self):
+        return self.sim.clock.mono < self.busy_until
+
+    @busy.setter
+    def busy(self, value):
+        pass
+
+    @property
+    def time_to_refresh(self):
+        if self.last_refresh is None:
+            return 0
+        return max(self.last_refresh + self.seconds_per_frame -
+                   self.sim.clock.mono, 0)
+
+    @time_to_refresh.setter
+    def time_to_refresh(self, value):
+        pass
+
+    def update_refresh_mode(self, start_sequence, seconds_per_frame):
+        self.seconds_per_frame = seconds_per_frame
+
+    def refresh(self):
+        sim = self.sim
+        if self.time_to_refresh > 0:
+            raise RuntimeError('Refresh too soon')
+        if sim.first_values is not None and sim.first_useful_refresh is None:
+            sim.first_useful_refresh = sim.clock.mono
+        self.last_refresh = sim.clock.mono
+        sim.stats['refreshes'] += 1
+        sim.stats['refresh secs'] += EINK_REFRESH_SECS
+        self.busy_until = sim.clock.mono + EINK_REFRESH_SECS
+        return True
+
+
+## the stand-in modules
+
+def _module(name, **attrs):
+    mod = _StandInModule(name)
+    for attr, value in attrs.items():
+        setattr(mod, attr, value)
+    return mod
+
+
+def build_modules(sim):
+    """sys.modules entries for everything board- or network-side"""
+    clock = sim.clock
+
+    def exit_and_deep_sleep_until_alarms(*alarms):
+        raise DeepSleep(min(a.monotonic_time for a in alarms))
+
+    class RTC:
+        @property
+        def datetime(self):
+            return time.gmtime(clock.rtc())
+
+        @datetime.setter
+        def datetime(self, value):
+            clock.set_rtc(calendar.timegm(value))
+
+    class MQTT:
+        def __init__(self, broker, port=None, username=None, password=None,
+                     socket_pool=None, ssl_context=None, **kwargs):
+            self.broker = broker
+            self.sim = sim
+
+    def ssd1680(display_bus, *, width, height, **kwargs):
+        sim.stats['display inits'] += 1
+        return SimDisplay(sim, width, height,
+                          kwargs.get('seconds_per_frame', 180))
+
+    try:
+        import adafruit_ssd1680
+        start_sequence = adafruit_ssd1680._START_SEQUENCE
+    except Exception:
+        start_sequence = bytes(41)
+
+    alarm_time = _module('alarm.time', TimeAlarm=lambda monotonic_time=None,
+                         epoch_time=None: types.SimpleNamespace(
+                             monotonic_time=monotonic_time))
+    mods = {
+        'time': clock.module(),
+        'asyncio': clock.asyncio_module(),
+        'alarm': _module('alarm', sleep_memory=sim.sleep_memory,
+                         time=alarm_time, exit_and_deep_sleep_until_alarms=
+                         exit_and_deep_sleep_until_alarms),
+        'alarm.time': alarm_time,
+        'board': _module('board', I2C=lambda: sim.i2c),
+        'rtc': _module('rtc', RTC=RTC),
+        # (a real default context costs ~50 ms to load the CA certs)
+        'ssl': _module('ssl', create_default_context=lambda: None),
+        'wifi': _module('wifi', radio=sim.radio),
+        'socketpool': _module('socketpool', SocketPool=SimPool),
+        'adafruit_requests': _module('adafruit_requests', Session=SimSession),
+        'adafruit_minimqtt': _module('adafruit_minimqtt'),
+        'adafruit_minimqtt.adafruit_minimqtt': _module(
+            'adafruit_minimqtt.adafruit_minimqtt', MQTT=MQTT,
+            MMQTTException=MMQTTException),
+        'adafruit_io': _module('adafruit_io'),
+        'adafruit_io.adafruit_io': _module('adafruit_io.adafruit_io',
+                                           IO_MQTT=SimIO_MQTT),
+        'adafruit_io.adafruit_io_errors': _module(
+            'adafruit_io.adafruit_io_errors',
+            AdafruitIO_MQTTError=AdafruitIO_MQTTError),
+        'adafruit_bme280': _module('adafruit_bme280'),
+        'adafruit_bme280.advanced': _module(
+            'adafruit_bme280.advanced',
+            Adafruit_BME280_I2C=lambda i2c, address=0x77: SimBME280(sim,
+                                                                    address),
+            MODE_SLEEP=SimBME280.MODE_SLEEP, MODE_FORCE=SimBME280.MODE_FORCE,
+            MODE_NORMAL=SimBME280.MODE_NORMAL, OVERSCAN_DISABLE=0,
+            OVERSCAN_X1=1, OVERSCAN_X2=2, OVERSCAN_X4=3, OVERSCAN_X8=4,
+            OVERSCAN_X16=5, IIR_FILTER_DISABLE=0),
+        'adafruit_sht31d': _module('adafruit_sht31d', SHT31D=SimSHT31D),
+        'adafruit_lc709203f': _module(
+            'adafruit_lc709203f',
+            LC709203F=lambda i2c: SimLC709203F(sim),
+            PackSize=types.SimpleNamespace(MAH100=100, MAH200=200,
+                                           MAH400=400, MAH500=500,
+                                           MAH1000=1000, MAH2000=2000,
+                                           MAH3000=3000)),
+        'adafruit_bus_device': _module('adafruit_bus_device'),
+        'adafruit_bus_device.i2c_device': _module(
+            'adafruit_bus_device.i2c_device', I2CDevice=SimI2CDevice),
+        'adafruit_ssd1680': _module('adafruit_ssd1680', SSD1680=ssd1680,
+                                    _START_SEQUENCE=start_sequence),
+        'digitalio': _module('digitalio'),
+        'fourwire': _module('fourwire'),
+        'secrets': _module('secrets', secrets={
+            'ssid': 'porch', 'password': 'hunter2', 'aio_username': 'sim',
+            'aio_key': 'aio_sim_key'}),
+    }
+    # make "import a.b" and "from a import b" find the submodules
+    for name, mod in mods.items():
+        parent, _, child = name.rpartition('.')
+        if parent:
+            setattr(mods[parent], child, mod)
+    return mods
+
+
+@contextlib.contextmanager
+def stand_ins(modules):
+    saved = {name: sys.modules.get(name) for name in modules}
+    sys.modules.update(modules)
+    try:
+        yield
+    finally:
+        for name, mod in saved.items():
+            if mod is None:
+                del sys.modules[name]
+            else:
+                sys.modules[name] = mod
+
+
+def compile_script(fname, settings):
+    """Compile a script with some of its top-level knobs overridden"""
+    with open(fname) as f:
+        tree = ast.parse(f.read(), fname)
+    found = set()
+    for node in tree.body:
+        if (isinstance(node, ast.Assign) and len(node.targets) == 1 and
+                isinstance(node.targets[0], ast.Name) and
+                node.targets[0].id in settings):
+            name = node.targets[0].id
+            node.value = ast.parse(repr(settings[name]), mode='eval').body
+            found.add(name)
+    unknown = set(settings) - found
+    if unknown:
+        raise ValueError(f'{fname} has no knob {", ".join(sorted(unknown))}')
+    return compile(ast.fix_missing_locations(tree), fname, 'exec')
+
+
+## the runs
+
+def run_node(sim, settings):
+    """Wake/sleep prototype.py until the simulated time is up"""
+    code = compile_script('prototype.py', settings)
+    with stand_ins(build_modules(sim)):
+        while sim.clock.mono < sim.end:
+            sim.boot()
+            try:
+                exec(code, {'__name__': '__main__'})
+            except DeepSleep as sleep:
+                sim.deep_sleep(sleep.until)
+            else:
+                raise RuntimeError('prototype.py returned without deep sleep')
+
+
+def run_display(sim, settings):
+    """Run eink-display.py (its __main__ retry loop and all) until the
+    simulated time is up.  Returns the exception it died of, if any."""
+    import bitmaptools
+    code = compile_script('eink-display.py', settings)
+    sim.clock.limit = sim.end
+    with stand_ins(build_modules(sim)), contextlib.ExitStack() as stack:
+        # nobody looks at the pixels: skip Blinka's (pure Python) glyph
+        # blits, which would be most of the run time
+        stack.callback(setattr, bitmaptools, 'blit', bitmaptools.blit)
+        bitmaptools.blit = lambda *args, **kwargs: None
+        try:
+            exec(code, {'__name__': '__main__'})
+        except SimEnd:
+            return None
+        except Exception as e:
+            return e
+
+
+def report_node(sim, days, wall_secs):
+    s = sim.stats
+    wakes = s['wakes']
+    print(f'node: {days:g} days, {wakes} wakes, simulated in {wall_secs:.1f} s')
+    print(f'  publishes:  {s["publishes ok"]} ok, {s["publishes failed"]} '
+          f'failed, {s["offline wakes"]} wakes without the radio')
+    print(f'  wifi:       {s["wifi connects"]} connects ({s["wifi fast"]} fast, '
+          f'{s["wifi full"]} full), {s["wifi failures"]} failed')
+    print(f'  mqtt:       {s["mqtt connects"]} connects, {s["mqtt failures"]} '
+          f'failed, {s["mqtt stale broker"]} to a stale broker address, '
+          f'{s["mqtt publishes"]} publishes')
+    print(f'  http:       {s["http requests"]} requests, '
+          f'{s["http failures"]} failed; dns: {s["dns lookups"]} lookups, '
+          f'{s["dns failures"]} failed')
+    sampled = s['sht30 conversions']
+    temps = sim.points['alt-temp']
+    stamps = [t for t, v in temps]
+    print(f'  samples:    {sampled} taken, {len(temps)} delivered to alt-temp '
+          f'({len(stamps) - len(set(stamps))} duplicates)')
+    for feed in sorted(set(sim.points) - {'alt-temp', 'alt-humidity',
+                                          'pressure', 'battery-charge'}):
+        print(f'  {feed + ":":11s} {len(sim.points[feed])} points, last '
+              f'{sim.points[feed][-1][1]!r}')
+    if wakes:
+        print(f'  awake:      {s["awake secs"] / wakes:.2f} s mean, '
+              f'{sim.awake_max:.2f} s max, radio '
+              f'{s["radio secs"] / wakes:.2f} s mean; '
+              f'{100 * s["awake secs"] / sim.clock.mono:.2f}% of the time')
+    print(f'  battery:    {sim.battery.percent:.1f}% left of '
+          f'{sim.battery.mah} mAh ({sim.battery.used:.0f} mAh used)')
+
+
+def report_display(sim, days, wall_secs, died):
+    s = sim.stats
+    simulated = sim.clock.mono / 86400
+    print(f'display: {simulated:.2f} of {days:g} days, simulated in '
+          f'{wall_secs:.1f} s')
+    print(f'  wifi:       {s["wifi connects"]} connects, '
+          f'{s["wifi failures"]} failed, {s["wifi drops"]} lost associations')
+    print(f'  display:    {s["display inits"]} initializations')
+    print(f'  mqtt:       {s["mqtt connects"]} connects, {s["mqtt failures"]} '
+          f'failed, {s["mqtt drops"]} dropped connections, '
+          f'{sim.mqtt_max_gap:.1f} s longest unserviced')
+    print(f'  messages:   {s["time messages"]} time, {s["feed messages"]} feed '
+          f'updates')
+    print(f'  refreshes:  {s["refreshes"]} (panel busy '
+          f'{s["refresh secs"] / 3600:.1f} h)')
+    if sim.first_useful_refresh is not None:
+        print(f'  first frame with feed values: '
+              f'{sim.first_useful_refresh:.1f} s after start')
+    if died:
+        print(f'  DIED after {simulated:.2f} days: {died!r}')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Simulate the sensor node or the e-ink display for days '
+                    'of virtual time')
+    parser.add_argument('target', choices=['node', 'display'])
+    parser.add_argument('--days', type=float, default=30)
+    parser.add_argument('--fail', metavar='KIND=P', action='append',
+                        default=[],
+                        help=f'inject failures, KIND one of {", ".join(FAULTS)}')
+    parser.add_argument('--set', metavar='KNOB=VALUE', action='append',
+                        default=[],
+                        help='override a config knob of the script, '
+                             'e.g. --set BATCH_WAKES=12')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--export', metavar='DIR',
+                        help='write what each feed received to DIR/FEED.json '
+                             '(in the format of an Adafruit IO export)')
+    parser.add_argument('--verbose', action='store_true',
+                        help="show the script's own log output")
+    args = parser.parse_args()
+
+    faults = {}
+    for item in args.fail:
+        kind, _, p = item.partition('=')
+        if kind not in FAULTS:
+            parser.error(f'unknown failure kind: {kind}')
+        faults[kind] = float(p)
+    settings = {}
+    for item in args.set:
+        knob, _, value = item.partition('=')
+        settings[knob] = ast.literal_eval(value)
+
+    # (relative to where we were run from, not the chdir below)
+    if args.export:
+        args.export = os.path.abspath(args.export)
+    # the scripts load fonts relative to the CIRCUITPY root
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    sim = Sim(args.days, faults, args.seed)
+    quiet = open(os.devnull, 'w')
+    t0 = time.perf_counter()
+    with contextlib.ExitStack() as stack:
+        if not args.verbose:
+            stack.enter_context(contextlib.redirect_stdout(quiet))
+            stack.enter_context(contextlib.redirect_stderr(quiet))
+            # (it grabbed sys.stderr when adafruit_logging was imported)
+            handler = adafruit_logging._default_handler
+            level = handler.level
+            handler.setLevel(adafruit_logging.CRITICAL + 1)
+            stack.callback(handler.setLevel, level)
+        if args.target == 'node':
+            run_node(sim, settings)
+        else:
+            died = run_display(sim, settings)
+    wall_secs = time.perf_counter() - t0
+
+    if args.export:
+        os.makedirs(args.export, exist_ok=True)
+        for feed, points in sim.points.items():
+            with open(os.path.join(args.export, f'{feed}.json'), 'w') as f:
+                json.dump([{'created_at': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                                        time.gmtime(t)),
+                            'value': value} for t, value in points], f)
+
+    if args.target == 'node':
+        report_node(sim, args.days, wall_secs)
+    else:
+        report_display(sim, args.days, wall_secs, died)
+        if died:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
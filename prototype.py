@@ -4,22 +4,29 @@
 
 
 import time
+import json
+import struct
 import alarm
 import board
 import digitalio
+import rtc
 import adafruit_logging as logging
 import traceback
 
 import wifi
 import ssl
 import socketpool
+import ipaddress
+import adafruit_requests
 
-import adafruit_bme280.basic
+from adafruit_bme280 import advanced as adafruit_bme280
 import adafruit_sht31d
+from adafruit_bus_device.i2c_device import I2CDevice
 import adafruit_lc709203f
 
 import adafruit_minimqtt.adafruit_minimqtt as MQTT
 from adafruit_io.adafruit_io import IO_MQTT
+from adafruit_io.adafruit_io_errors import AdafruitIO_MQTTError
 
 
 #print('code.py starting up...')
@@ -31,17 +38,91 @@ UPDATE_INTVL = 300
 #BATT_SIZE =  adafruit_lc709203f.PackSize.MAH400
 BATT_SIZE =  adafruit_lc709203f.PackSize.MAH3000
 
+## adaptive interval: stretch UPDATE_INTVL as the battery drains, shorten
+## it while readings move fast, and keep it within MIN/MAX_UPDATE_INTVL.
+## Changes of interval (and why) are published to INTVL_FEED.
+ADAPTIVE_INTVL = False
+MIN_UPDATE_INTVL = 60
+MAX_UPDATE_INTVL = 3600
+## (charge %, interval multiplier), highest charge first
+BATT_STEPS = [(40, 1), (25, 2), (10, 4), (0, 12)]
+## rates (per minute) that count as moving fast, and what that divides
+## the interval by
+FAST_RATES = {'Alt-Temp': 0.2,
+              'Alt-Humidity': 1.0,
+              'Pressure': 0.005,
+              }
+FAST_DIVISOR = 3
+INTVL_FEED = 'Update-Intvl'
+
+## batching: log samples in alarm.sleep_memory and only bring up the
+## network every BATCH_WAKES wakeups (or when the log is nearly full), then
+## upload the backlog with AIO's timestamped batch API.  1 = no batching.
+BATCH_WAKES = 1
+## server can be overridden (secrets['aio_url']) to test against a stand-in
+AIO_URL = "https://io.adafruit.com"
+
+## fast reconnect: reuse the last channel/BSSID, DHCP lease and broker
+## address (kept in alarm.sleep_memory), falling back to a full scan + DHCP
+FAST_CONNECT = True
+FAST_CONNECT_TIMEOUT = 5
+## redo DHCP (and re-resolve the broker) after this many reuses of the lease
+LEASE_REUSE_WAKES = 288
+
+## wake-cycle profiling: keep the phase timings of the last PROFILE_HISTORY
+## wakes, and publish a summary of them every PROFILE_PUBLISH_WAKES wakes
+PROFILE_HISTORY = 24
+PROFILE_PUBLISH_WAKES = 12
+PROFILE_FEED = 'Wake-Profile'
+
+## publish-on-change: only bring up the radio if some value moved by at
+## least its deadband since the last publish, or HEARTBEAT_INTVL (seconds)
+## has passed.  Feeds without a deadband are always published.
+CHANGE_GATING = False
+DEADBANDS = {'Alt-Temp': 0.2,
+             'Alt-Humidity': 0.5,
+             'Pressure': 0.05,
+             'Battery-Charge': 1.0,
+             }
+HEARTBEAT_INTVL = 3600
+
+## alarm.sleep_memory layout
+NETCACHE_ADDR = 0       # NetCache
+PROFILE_ADDR = 64       # PhaseTimer
+PUBLISHED_ADDR = 896    # PublishGate
+SCHEDULER_ADDR = 960    # IntervalScheduler
+SAMPLELOG_ADDR = 1024   # SampleLog, to the end of sleep memory
+
+## publish all values as one JSON message to this group (as eink-display.py
+## subscribes to it), instead of one message per feed.  None = per feed
+## (the group has to exist: the broker silently drops a publish to a missing
+## one, so there's no telling at run time).
+PUBLISH_GROUP = 'Porch'
+
+## feeds we publish, with the scale used to pack them as 16-bit ints
+FEEDS = [('Alt-Temp', 100),
+         ('Alt-Humidity', 100),
+         ('Pressure', 1000),
+         ('Battery-Charge', 10),
+         ]
+
 logger = logging.getLogger('main')
 logger.setLevel(logging.INFO)
 
 
 class temp_sensor_bme280:
     """Reads multiple weather values (temp, humidity, pressure)"""
-
-    def __init__(self, i2c, pressure_calib=None):
+    # registers: calibration (dig_T1..dig_P9), status, and the readings
+    # (press_msb .. temp_xlsb)
+    CALIB = 0x88
+    CALIB_FORMAT = '<HhhHhhhhhhhh'
+    STATUS = 0xF3
+    DATA = 0xF7
+
+    def __init__(self, i2c, pressure_calib=None, address=0x77):
         """Set up Temp sensor"""
         super().__init__()
-        self.bme280 = adafruit_bme280.basic.Adafruit_BME280_I2C(i2c)
+        self.bme280 = adafruit_bme280.Adafruit_BME280_I2C(i2c, address)
 
         # change this to match the location's pressure (hPa) at sea level
         if (pressure_calib):
@@ -49,43 +130,150 @@ class temp_sensor_bme280:
         else:
             self.bme280.sea_level_pressure = 1013.25
 
+        ## One sample per wake: forced mode, so it sleeps (and doesn't
+        ## self-heat) between wakes, with the datasheet's "weather
+        ## monitoring" settings: 1x oversampling, no IIR filter.  We don't
+        ## use its humidity, so skip that conversion.
+        self.bme280.mode = adafruit_bme280.MODE_SLEEP
+        self.bme280.overscan_temperature = adafruit_bme280.OVERSCAN_X1
+        self.bme280.overscan_pressure = adafruit_bme280.OVERSCAN_X1
+        self.bme280.overscan_humidity = adafruit_bme280.OVERSCAN_DISABLE
+        self.bme280.iir_filter = adafruit_bme280.IIR_FILTER_DISABLE
+        self.started = False
+
+        ## The library starts another conversion (and waits for it) on every
+        ## read in forced mode, so the library only starts ours, and we read
+        ## the result from the registers ourselves.  (The library already
+        ## probed the address.)
+        self.device = I2CDevice(i2c, address, probe=False)
+        calib = bytearray(struct.calcsize(self.CALIB_FORMAT))
+        self._read_regs(self.CALIB, calib)
+        (self.dig_T1, self.dig_T2, self.dig_T3, self.dig_P1, *self.dig_P
+         ) = struct.unpack(self.CALIB_FORMAT, calib)
+        self.temp_C = self.pressure = None
+
+    def _read_regs(self, reg, buf):
+        with self.device as i2c:
+            i2c.write_then_readinto(bytes((reg,)), buf)
+
+    def start(self):
+        """Start a forced-mode conversion (about 5 ms with these settings)"""
+        self.bme280.mode = adafruit_bme280.MODE_FORCE
+        self.started = True
+
+    def read(self):
+        """Wait for the conversion to finish, and compensate its readings
+        (the datasheet's floating point formulas)"""
+        if not self.started:
+            self.start()
+        status = bytearray(1)
+        self._read_regs(self.STATUS, status)
+        while status[0] & 0x08:         # measuring
+            time.sleep(0.001)
+            self._read_regs(self.STATUS, status)
+        data = bytearray(6)
+        self._read_regs(self.DATA, data)
+        self.started = False
+        adc_p = (data[0] << 12) | (data[1] << 4) | (data[2] >> 4)
+        adc_t = (data[3] << 12) | (data[4] << 4) | (data[5] >> 4)
+
+        var1 = (adc_t / 16384.0 - self.dig_T1 / 1024.0) * self.dig_T2
+        var2 = (adc_t / 131072.0 - self.dig_T1 / 8192.0) ** 2 * self.dig_T3
+        t_fine = var1 + var2
+        self.temp_C = t_fine / 5120.0
+
+        P2, P3, P4, P5, P6, P7, P8, P9 = self.dig_P
+        var1 = t_fine / 2.0 - 64000.0
+        var2 = var1 * var1 * P6 / 32768.0
+        var2 = var2 + var1 * P5 * 2.0
+        var2 = var2 / 4.0 + P4 * 65536.0
+        var1 = (P3 * var1 * var1 / 524288.0 + P2 * var1) / 524288.0
+        var1 = (1.0 + var1 / 32768.0) * self.dig_P1
+        if not var1:
+            raise ArithmeticError('BME280 pressure calibration is invalid')
+        pressure = 1048576.0 - adc_p
+        pressure = (pressure - var2 / 4096.0) * 6250.0 / var1
+        var1 = P9 * pressure * pressure / 2147483648.0
+        var2 = pressure * P8 / 32768.0
+        self.pressure = (pressure + (var1 + var2 + P7) / 16.0) / 100
+
     def get_temp_F(self):
+        if self.temp_C is None:
+            self.read()
         # convert C to F
-        return self.bme280.temperature * 9/5 + 32
-
-    def get_humidity(self):
-        return self.bme280.relative_humidity
+        return self.temp_C * 9/5 + 32
 
     def get_barometric(self):
         """return pressure in in-Hg"""
+        if self.pressure is None:
+            self.read()
         # 1 in-Hg = 3,386.388640341 Pa = 33.8638864 hPa
-        return self.bme280.pressure / 33.8638864 
+        return self.pressure / 33.8638864 
+
+
+def crc8(data):
+    """Sensirion CRC-8 (polynomial 0x31, init 0xff)"""
+    crc = 0xff
+    for byte in data:
+        crc ^= byte
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x31 if crc & 0x80 else crc << 1) & 0xff
+    return crc
 
 
 class temp_sensor_sht30:
     """Reads multiple weather values (temp, humidity, pressure)"""
+    # single shot, high repeatability, no clock stretching
+    MEASURE = b'\x24\x00'
+    # max measurement time for high repeatability (15.5 ms)
+    MEASURE_TIME = 0.016
 
     def __init__(self, i2c):
         """Set up Temp sensor"""
         super().__init__()
         self.sensor = adafruit_sht31d.SHT31D(i2c)
 
-        ## We'll be sampling this infrequently, so use High repeatability
-        ## and single shot mode to let the sensor do the averaging.
-        ## Unclear if clock_stretching is needed, but turn on just in case.
-        self.sensor.mode = adafruit_sht31d.MODE_SINGLE
-        self.sensor.repeatability = adafruit_sht31d.REP_HIGH
-        self.sensor.clock_stretching = True
-
         logger = logging.getLogger('temp')
         logger.info(f"SHT30 serial num: {self.sensor.serial_number:#x}")
 
+        ## We'll be sampling this infrequently, so use High repeatability
+        ## single shot measurements to let the sensor do the averaging.
+        ## The library would block (and do one measurement for temperature
+        ## and another for humidity), so talk to it directly: start() and
+        ## read() one measurement, without clock stretching, so the bus is
+        ## free for the other sensors in between.
+        self.device = self.sensor.i2c_device
+        self.temp_C = self.humidity = None
+
+    def start(self):
+        with self.device as i2c:
+            i2c.write(self.MEASURE)
+
+    def read(self):
+        """Read the measurement, at least MEASURE_TIME after start()"""
+        data = bytearray(6)
+        with self.device as i2c:
+            i2c.readinto(data)
+        if crc8(data[0:2]) != data[2] or crc8(data[3:5]) != data[5]:
+            raise RuntimeError('SHT30 CRC mismatch')
+        self.temp_C = -45 + 175 * ((data[0] << 8) | data[1]) / 65535
+        self.humidity = 100 * ((data[3] << 8) | data[4]) / 65535
+
+    def measure(self):
+        self.start()
+        time.sleep(self.MEASURE_TIME)
+        self.read()
+
     def get_temp_F(self):
+        if self.temp_C is None:
+            self.measure()
         # convert C to F
-        return self.sensor.temperature * 9/5 + 32
+        return self.temp_C * 9/5 + 32
 
     def get_humidity(self):
-        return self.sensor.relative_humidity
+        if self.humidity is None:
+            self.measure()
+        return self.humidity
 
 
 class batt_sensor:
@@ -129,9 +317,301 @@ class neo_led:
     pass
 
 
-def get_network_io_handle():
-    """Configure wifi network and Adafruit_IO handle"""
-
+class SampleLog:
+    """Timestamped samples packed into alarm.sleep_memory, which survives
+    deep sleep (but not a power cycle).
+
+    Keeps, per feed, how many of the samples were already uploaded, so a
+    failed upload is resumed without losing or repeating any points."""
+    MAGIC = 0x5A01
+    # magic, sample count, wakes since last upload, then sent count per feed
+    HEADER = '<HHH' + 'H' * len(FEEDS)
+    # time.time(), then the feed values scaled to 16 bits
+    RECORD = '<I' + 'h' * len(FEEDS)
+
+    def __init__(self, mem, addr):
+        self.mem = mem
+        self.addr = addr
+        self.hdr_size = struct.calcsize(self.HEADER)
+        self.rec_size = struct.calcsize(self.RECORD)
+        self.capacity = (len(mem) - addr - self.hdr_size) // self.rec_size
+        hdr = struct.unpack_from(self.HEADER, mem, addr)
+        if hdr[0] != self.MAGIC or hdr[1] > self.capacity:
+            # first boot (or a power cycle wiped it)
+            self.clear()
+        else:
+            self.count = hdr[1]
+            self.wakes = hdr[2]
+            self.sent = list(hdr[3:])
+
+    def clear(self):
+        self.count = 0
+        self.wakes = 0
+        self.sent = [0] * len(FEEDS)
+        self.save()
+
+    def save(self):
+        struct.pack_into(self.HEADER, self.mem, self.addr,
+                         self.MAGIC, self.count, self.wakes, *self.sent)
+
+    def nearly_full(self):
+        return self.count >= self.capacity - 1
+
+    def append(self, timestamp, values):
+        if self.count == self.capacity:
+            # out of room: drop the oldest sample
+            h, r = self.addr + self.hdr_size, self.rec_size
+            self.mem[h:h+(self.count-1)*r] = self.mem[h+r:h+self.count*r]
+            self.count -= 1
+            self.sent = [max(n - 1, 0) for n in self.sent]
+        scaled = [round(v * scale) for v, (name, scale) in zip(values, FEEDS)]
+        struct.pack_into(self.RECORD, self.mem,
+                         self.addr + self.hdr_size + self.count * self.rec_size,
+                         timestamp, *scaled)
+        self.count += 1
+        self.save()
+
+    def samples(self, start=0):
+        """Yields (timestamp, [values]) from sample number start on"""
+        for i in range(start, self.count):
+            rec = struct.unpack_from(self.RECORD, self.mem,
+                                     self.addr + self.hdr_size + i * self.rec_size)
+            yield rec[0], [v / scale for v, (name, scale) in zip(rec[1:], FEEDS)]
+
+
+class NetCache:
+    """Last good Wi-Fi association (channel, BSSID), DHCP lease and broker
+    address, kept in alarm.sleep_memory for a fast reconnect on next wake"""
+    MAGIC = 0x5A02
+    # magic, reuses of the lease, channel, BSSID, then IPv4 address,
+    # netmask, gateway, DNS server and broker address (packed)
+    FORMAT = '<HHB6s4s4s4s4s4s'
+    NO_ADDR = bytes(4)
+
+    def __init__(self, mem, addr):
+        self.mem = mem
+        self.addr = addr
+        (magic, self.uses, self.channel, self.bssid, self.ipv4, self.netmask,
+         self.gateway, self.dns, self.broker) = struct.unpack_from(self.FORMAT,
+                                                                   mem, addr)
+        self.valid = magic == self.MAGIC and self.uses < LEASE_REUSE_WAKES
+
+    def save(self):
+        struct.pack_into(self.FORMAT, self.mem, self.addr,
+                         self.MAGIC if self.valid else 0, self.uses,
+                         self.channel, self.bssid, self.ipv4, self.netmask,
+                         self.gateway, self.dns, self.broker)
+
+    def invalidate(self):
+        self.valid = False
+        self.save()
+
+    def store_lease(self):
+        """Remember the association and lease we just got from a full connect"""
+        radio = wifi.radio
+        self.channel = radio.ap_info.channel
+        self.bssid = bytes(radio.ap_info.bssid)
+        self.ipv4 = radio.ipv4_address.packed
+        self.netmask = radio.ipv4_subnet.packed
+        self.gateway = radio.ipv4_gateway.packed
+        self.dns = radio.ipv4_dns.packed
+        self.broker = self.NO_ADDR
+        self.uses = 0
+        self.valid = True
+        self.save()
+
+    def broker_addr(self):
+        if self.broker == self.NO_ADDR:
+            return None
+        return '.'.join(str(b) for b in self.broker)
+
+    def store_broker(self, addr):
+        self.broker = ipaddress.IPv4Address(addr).packed
+        self.save()
+
+
+class PhaseTimer:
+    """Times the phases of a wake cycle with time.monotonic_ns(), keeping
+    the last PROFILE_HISTORY cycles (in ms) in alarm.sleep_memory.
+
+    Each phase is charged the time since the previous mark(); the deep
+    sleep that follows a cycle is filled in on the next wake."""
+    PHASES = ('i2c', 'sht30', 'bme280', 'batt',
+              'wifi', 'mqtt', 'publish', 'sleep')
+    MAGIC = 0x5A03
+    # magic, next slot, cycles recorded, cycles since the last summary,
+    # monotonic_ns() when we went to sleep
+    HEADER = '<HHHHQ'
+    RECORD = '<' + 'I' * len(PHASES)
+
+    def __init__(self, mem, addr):
+        self.last = time.monotonic_ns()
+        self.mem = mem
+        self.addr = addr
+        self.hdr_size = struct.calcsize(self.HEADER)
+        self.rec_size = struct.calcsize(self.RECORD)
+        self.ms = [0] * len(self.PHASES)
+        (magic, self.slot, self.count, self.unsent,
+         slept_at) = struct.unpack_from(self.HEADER, mem, addr)
+        if magic != self.MAGIC:
+            self.slot = self.count = self.unsent = 0
+        elif self.count and self.last > slept_at:
+            prev = (self.slot - 1) % PROFILE_HISTORY
+            struct.pack_into('<I', mem, self._rec_addr(prev)
+                             + 4 * self.PHASES.index('sleep'),
+                             (self.last - slept_at) // 1000000)
+
+    def _rec_addr(self, slot):
+        return self.addr + self.hdr_size + slot * self.rec_size
+
+    def mark(self, phase):
+        """End of phase: charge it the time since the last mark"""
+        now = time.monotonic_ns()
+        self.ms[self.PHASES.index(phase)] += (now - self.last) // 1000000
+        self.last = now
+
+    def finish(self):
+        """Save this cycle, just before going to deep sleep"""
+        struct.pack_into(self.RECORD, self.mem, self._rec_addr(self.slot),
+                         *self.ms)
+        self.slot = (self.slot + 1) % PROFILE_HISTORY
+        self.count = min(self.count + 1, PROFILE_HISTORY)
+        # (an 'H' in the header: stop there if the summary never gets out)
+        self.unsent = min(self.unsent + 1, 0xFFFF)
+        struct.pack_into(self.HEADER, self.mem, self.addr, self.MAGIC,
+                         self.slot, self.count, self.unsent,
+                         time.monotonic_ns())
+
+    def records(self):
+        for i in range(self.count):
+            yield struct.unpack_from(self.RECORD, self.mem, self._rec_addr(i))
+
+    def summary_due(self):
+        return self.unsent >= PROFILE_PUBLISH_WAKES
+
+    def summary(self):
+        """e.g. 'n=24 i2c=31/40 sht30=16/16 ... sleep=298710/299020', with
+        mean/max ms per phase over the cycles that had that phase"""
+        parts = [f'n={self.count}']
+        for i, phase in enumerate(self.PHASES):
+            times = [rec[i] for rec in self.records() if rec[i]]
+            if times:
+                parts.append(f'{phase}={sum(times) // len(times)}/{max(times)}')
+        return ' '.join(parts)
+
+    def summary_sent(self):
+        self.unsent = 0
+
+
+class PublishGate:
+    """Last published values (and when), kept in alarm.sleep_memory, to
+    skip the radio on wakes where nothing moved past its deadband"""
+    MAGIC = 0x5A04
+    # magic, monotonic_ns() of the last publish, then the values published
+    FORMAT = '<HQ' + 'f' * len(FEEDS)
+
+    def __init__(self, mem, addr):
+        self.mem = mem
+        self.addr = addr
+        self.now = time.monotonic_ns()
+        fields = struct.unpack_from(self.FORMAT, mem, addr)
+        self.valid = fields[0] == self.MAGIC
+        self.published_at = fields[1]
+        self.values = fields[2:]
+
+    def reason(self, values):
+        """Why values (list of (feed, value)) should be published, or None"""
+        if not self.valid or self.now < self.published_at:
+            return 'first'
+        if self.now - self.published_at >= HEARTBEAT_INTVL * 1000000000:
+            return 'heartbeat'
+        for (name, value), last in zip(values, self.values):
+            if abs(value - last) >= DEADBANDS.get(name, 0):
+                return name
+        return None
+
+    def mark_published(self, values):
+        struct.pack_into(self.FORMAT, self.mem, self.addr, self.MAGIC,
+                         self.now, *[v for n,v in values])
+
+
+class IntervalScheduler:
+    """Picks the sleep interval from the battery charge and how fast the
+    readings move.  Keeps the last sample, and the last interval reported
+    to INTVL_FEED, in alarm.sleep_memory."""
+    MAGIC = 0x5A05
+    REASONS = ('normal', 'battery', 'fast', 'battery+fast')
+    # magic, monotonic_ns() of the last sample, the interval and reason
+    # last reported, then the last sample
+    FORMAT = '<HQHB' + 'f' * len(FEEDS)
+
+    def __init__(self, mem, addr):
+        self.mem = mem
+        self.addr = addr
+        self.now = time.monotonic_ns()
+        fields = struct.unpack_from(self.FORMAT, mem, addr)
+        self.valid = fields[0] == self.MAGIC and self.now > fields[1]
+        self.sampled_at = fields[1]
+        self.reported = fields[2:4] if fields[0] == self.MAGIC else (0, 0)
+        self.last = fields[4:]
+        self.intvl = UPDATE_INTVL
+        self.reason = 0
+
+    def save(self):
+        struct.pack_into(self.FORMAT, self.mem, self.addr, self.MAGIC,
+                         self.sampled_at, *self.reported, *self.last)
+
+    def choose(self, values):
+        """Pick (and return) the interval after sampling values, a list
+        of (feed, value)"""
+        charge = dict(values)['Battery-Charge']
+        mult = next((m for level, m in BATT_STEPS if charge >= level),
+                    BATT_STEPS[-1][1])
+        fast = None
+        if self.valid:
+            minutes = (self.now - self.sampled_at) / 60e9
+            for (name, value), last in zip(values, self.last):
+                if abs(value - last) >= FAST_RATES.get(name, 1e9) * minutes:
+                    fast = name
+                    break
+
+        intvl = UPDATE_INTVL * mult
+        if fast:
+            intvl //= FAST_DIVISOR
+        self.intvl = min(max(intvl, MIN_UPDATE_INTVL), MAX_UPDATE_INTVL)
+        self.reason = (mult > 1) + 2 * (fast is not None)
+
+        self.sampled_at = self.now
+        self.last = [v for n,v in values]
+        self.save()
+        logger.info(f"Next update in {self.intvl} s "
+                    f"({self.REASONS[self.reason]}: battery {charge:.0f}%"
+                    f"{', ' + fast + ' moving fast' if fast else ''})")
+        return self.intvl
+
+    def describe(self):
+        return f'{self.intvl} {self.REASONS[self.reason]}'
+
+    def changed(self):
+        return tuple(self.reported) != (self.intvl, self.reason)
+
+    def mark_reported(self):
+        self.reported = (self.intvl, self.reason)
+        self.save()
+
+
+def clock_is_set():
+    # the RTC keeps running through deep sleep, but starts at 2000-01-01
+    return time.localtime().tm_year >= 2020
+
+
+def iso_time(timestamp):
+    t = time.localtime(timestamp)
+    return (f'{t.tm_year:04d}-{t.tm_mon:02d}-{t.tm_mday:02d}T'
+            f'{t.tm_hour:02d}:{t.tm_min:02d}:{t.tm_sec:02d}Z')
+
+
+def get_secrets():
     # Get wifi details and more from a secrets.py file
     try:
         from secrets import secrets
@@ -139,35 +619,190 @@ def get_network_io_handle():
         print("WiFi connect failed: no secrets.py file")
         # maybe flash neopixel with some pattern?
         raise
+    return secrets
+
 
+def connect_wifi(secrets, netcache=None):
+    """Connect to the AP: first try the cached channel/BSSID with the cached
+    lease as a static IP (no scan, no DHCP), then a full scan + DHCP"""
     logger = logging.getLogger('wifi')
     mac = ':'.join(f'{i:02x}' for i in wifi.radio.mac_address)
     logger.info(f"My MAC addr: {mac}")
-
-    wifi.radio.connect(secrets["ssid"], secrets["password"])
+    start = time.monotonic()
+
+    mode = 'full'
+    if netcache and netcache.valid:
+        try:
+            wifi.radio.set_ipv4_address(
+                ipv4=ipaddress.IPv4Address(netcache.ipv4),
+                netmask=ipaddress.IPv4Address(netcache.netmask),
+                gateway=ipaddress.IPv4Address(netcache.gateway),
+                ipv4_dns=ipaddress.IPv4Address(netcache.dns))
+            wifi.radio.connect(secrets["ssid"], secrets["password"],
+                               channel=netcache.channel, bssid=netcache.bssid,
+                               timeout=FAST_CONNECT_TIMEOUT)
+            netcache.uses += 1
+            netcache.save()
+            mode = 'fast'
+        except ConnectionError as e:
+            logger.info(f"Fast connect failed ({e}), scanning")
+            netcache.invalidate()
+            wifi.radio.start_dhcp()
+
+    if mode == 'full':
+        wifi.radio.connect(secrets["ssid"], secrets["password"])
+        if netcache:
+            netcache.store_lease()
 
     logger.info("Connected to %s!"%secrets["ssid"])
     logger.info(f"My IP address is {wifi.radio.ipv4_address}")
+    logger.info(f"{mode} connect took {time.monotonic() - start:.2f} s")
+    profiler.mark('wifi')
+
+
+def upload_batch(log, values=None, netcache=None):
+    """Upload the logged samples to each feed with AIO's batch data API.
+    values (if not None) is the current sample, still to be timestamped."""
+    logger = logging.getLogger('batch')
+    secrets = get_secrets()
+    connect_wifi(secrets, netcache)
 
-    # Create a socket pool
     pool = socketpool.SocketPool(wifi.radio)
+    http = adafruit_requests.Session(pool, ssl.create_default_context())
+    aio_url = secrets.get('aio_url', AIO_URL)
+    headers = {'X-AIO-Key': secrets['aio_key']}
+
+    # (re)set the RTC (UTC) while we're online: it timestamps the samples
+    with http.get(f'{aio_url}/api/v2/time/seconds') as response:
+        rtc.RTC().datetime = time.localtime(int(response.text))
+    if values is not None:
+        log.append(time.time(), values)
+
+    for i, (name, scale) in enumerate(FEEDS):
+        if log.sent[i] >= log.count:
+            continue
+        data = [{'value': vals[i], 'created_at': iso_time(ts)}
+                for ts, vals in log.samples(log.sent[i])]
+        url = (f'{aio_url}/api/v2/{secrets["aio_username"]}/feeds/'
+               f'{name.lower()}/data/batch')
+        with http.post(url, json={'data': data}, headers=headers) as response:
+            if response.status_code != 200:
+                raise RuntimeError(f'batch upload to {name} failed: '
+                                   f'{response.status_code}')
+        # saved right away, so a later failure doesn't resend this feed
+        log.sent[i] = log.count
+        log.save()
+        logger.info(f'uploaded {len(data)} samples to {name}')
+    log.clear()
+
+    if profiler.summary_due():
+        url = (f'{aio_url}/api/v2/{secrets["aio_username"]}/feeds/'
+               f'{PROFILE_FEED.lower()}/data')
+        with http.post(url, json={'value': profiler.summary()},
+                       headers=headers) as response:
+            if response.status_code == 200:
+                profiler.summary_sent()
+    if scheduler and scheduler.changed():
+        url = (f'{aio_url}/api/v2/{secrets["aio_username"]}/feeds/'
+               f'{INTVL_FEED.lower()}/data')
+        with http.post(url, json={'value': scheduler.describe()},
+                       headers=headers) as response:
+            if response.status_code == 200:
+                scheduler.mark_reported()
+    profiler.mark('publish')
+
+
+def get_network_io_handle(netcache=None):
+    """Configure wifi network and return a connected Adafruit_IO handle"""
+    secrets = get_secrets()
+    connect_wifi(secrets, netcache)
 
-    # Initialize a new MQTT Client object
-    mqtt_client = MQTT.MQTT(
-        broker="io.adafruit.com",
-        port=1883,
-        username=secrets["aio_username"],
-        password=secrets["aio_key"],
-        socket_pool=pool,
-        ssl_context=ssl.create_default_context(),
-    )
+    # Create a socket pool
+    pool = socketpool.SocketPool(wifi.radio)
 
-    # Initialize an Adafruit IO MQTT Client
-    io = IO_MQTT(mqtt_client)
-    return io
+    broker = secrets.get("aio_broker", "io.adafruit.com")
+    broker_addr = cached_broker = netcache and netcache.broker_addr()
+    while True:
+        try:
+            if not broker_addr:
+                broker_addr = pool.getaddrinfo(broker, 1883)[0][4][0]
+                if netcache:
+                    netcache.store_broker(broker_addr)
+
+            # Initialize a new MQTT Client object
+            # (port 1883 is plain MQTT, so connecting by address is fine)
+            mqtt_client = MQTT.MQTT(
+                broker=broker_addr,
+                port=1883,
+                username=secrets["aio_username"],
+                password=secrets["aio_key"],
+                socket_pool=pool,
+                ssl_context=ssl.create_default_context(),
+            )
+
+            # Initialize an Adafruit IO MQTT Client
+            io = IO_MQTT(mqtt_client)
+            io.connect()
+            profiler.mark('mqtt')
+            return io
+        except (OSError, MQTT.MMQTTException, AdafruitIO_MQTTError):
+            if not cached_broker:
+                if netcache:
+                    # maybe the reused lease went bad: full connect next time
+                    netcache.invalidate()
+                raise
+            # the cached broker address may have gone stale: resolve it again
+            cached_broker = broker_addr = None
+
+
+def sample_sensors(sht30, bme280, batt):
+    """Read every sensor once, with the SHT30 and BME280 conversions
+    running at the same time.  Returns the values as [(feed, value)]"""
+    bme280.start()
+    sht30.start()
+    # the BME280's conversion is done well within the SHT30's
+    time.sleep(sht30.MEASURE_TIME)
+    sht30.read()
+    profiler.mark('sht30')    # (covers both conversions)
+    pressure = bme280.get_barometric()
+    profiler.mark('bme280')
+    charge = batt.get_level()
+    profiler.mark('batt')
+
+    return [('Alt-Temp', sht30.get_temp_F()),
+            ('Alt-Humidity', sht30.get_humidity()),
+            ('Pressure', pressure),
+            ('Battery-Charge', charge),
+            ]
+
+
+def publish_values(io, values):
+    """Publish values (list of (feed, value)) as a single message to the
+    PUBLISH_GROUP group, or one message per feed if it's None"""
+    if PUBLISH_GROUP:
+        # (no fallback: a broker without the group doesn't raise on a QoS 0
+        # publish, and when it does raise, the connection is gone anyway)
+        feeds = {name.lower(): value for name, value in values}
+        io.publish(PUBLISH_GROUP, json.dumps({'feeds': feeds}),
+                   is_group=True)
+    else:
+        io.publish_multiple(values)
+
+
+def publish_reports(io, profiler, scheduler):
+    """Publish the wake profile summary and the update interval, when due"""
+    if profiler.summary_due():
+        io.publish(PROFILE_FEED, profiler.summary())
+        profiler.summary_sent()
+    if scheduler and scheduler.changed():
+        io.publish(INTVL_FEED, scheduler.describe())
+        scheduler.mark_reported()
 
 
 logger.info("Connecting to Adafruit IO...")
+profiler = PhaseTimer(alarm.sleep_memory, PROFILE_ADDR)
+scheduler = IntervalScheduler(alarm.sleep_memory, SCHEDULER_ADDR) if ADAPTIVE_INTVL else None
+update_intvl = UPDATE_INTVL
 
 try:
     logger.debug(f"Publishing a new message every {UPDATE_INTVL} seconds...")
@@ -181,16 +816,15 @@ try:
     bme280 = temp_sensor_bme280(i2c)
     sht30 = temp_sensor_sht30(i2c)
     batt = batt_sensor(i2c, BATT_SIZE)
+    profiler.mark('i2c')
 
     ## Note: we grab values first to minimize CPU heating on temp value
-    values = [('Alt-Temp', sht30.get_temp_F()),
-              ('Alt-Humidity', sht30.get_humidity()),
-              ('Pressure', bme280.get_barometric()),
-              ('Battery-Charge', batt.get_level()),
-              ]
+    values = sample_sensors(sht30, bme280, batt)
+    if scheduler:
+        update_intvl = scheduler.choose(values)
     ## skip these in order to reduce battery consumption:
     #('Temp', bme280.get_temp_F()),
-    #('Humidity', bme280.get_humidity()),
+    #  (and the BME280's humidity, which isn't even converted now)
     #('Battery-V', batt.get_voltage()),
               
 
@@ -204,19 +838,51 @@ try:
             logger.debug(f"    {n}: {v}")
 
 
-    # Connect to Adafruit IO
-    io = get_network_io_handle()
+    netcache = NetCache(alarm.sleep_memory, NETCACHE_ADDR) if FAST_CONNECT else None
 
-    # Connect the callback methods defined above to Adafruit IO
-    # io.on_connect = connected
-    # io.on_disconnect = disconnected
-    # io.on_subscribe = subscribe
-    # io.on_unsubscribe = unsubscribe
-    # io.on_message = message
+    gate = PublishGate(alarm.sleep_memory, PUBLISHED_ADDR) if CHANGE_GATING else None
+    reason = gate.reason(values) if gate else None
 
-    io.connect()
-    io.publish_multiple(values)    
-    logger.info("Successful publish to Adafruit IO...")
+    if BATCH_WAKES > 1:
+        log = SampleLog(alarm.sleep_memory, SAMPLELOG_ADDR)
+        log.wakes += 1
+        if not clock_is_set():
+            # can't timestamp this one yet: upload_batch() sets the clock
+            upload_batch(log, [v for n,v in values], netcache)
+        else:
+            log.append(time.time(), [v for n,v in values])
+            if log.wakes < BATCH_WAKES and not log.nearly_full():
+                logger.info(f"Logged sample {log.count}, "
+                            f"wake {log.wakes} of {BATCH_WAKES}")
+            else:
+                upload_batch(log, netcache=netcache)
+                logger.info("Successful batch upload to Adafruit IO...")
+    elif gate and not reason:
+        logger.info("No value past its deadband, skipping publish")
+        # the reports still go out when due (the radio only comes on then)
+        if profiler.summary_due() or (scheduler and scheduler.changed()):
+            io = get_network_io_handle(netcache)
+            publish_reports(io, profiler, scheduler)
+            profiler.mark('publish')
+            logger.info("Published the reports to Adafruit IO...")
+    else:
+        # Connect to Adafruit IO
+        io = get_network_io_handle(netcache)
+
+        # Connect the callback methods defined above to Adafruit IO
+        # io.on_connect = connected
+        # io.on_disconnect = disconnected
+        # io.on_subscribe = subscribe
+        # io.on_unsubscribe = unsubscribe
+        # io.on_message = message
+
+        publish_values(io, values)
+        if gate:
+            gate.mark_published(values)
+            logger.info(f"Published ({reason})")
+        publish_reports(io, profiler, scheduler)
+        profiler.mark('publish')
+        logger.info("Successful publish to Adafruit IO...")
 
 
 except Exception as e:
@@ -233,9 +899,13 @@ except Exception as e:
 finally:
     # deep-sleep regardless of exception or not
     # (and restart everyhing on wakeup)
+    profiler.finish()
+    if DEBUG:
+        logger.debug(' '.join(f'{phase}={ms}' for phase, ms
+                              in zip(profiler.PHASES, profiler.ms)))
 
     # Create an alarm that will trigger NN seconds from the start.
-    wakeup_time = start_time + UPDATE_INTVL
+    wakeup_time = start_time + update_intvl
     # wrap this in try-block or otherwise check wakeup_time is in the future
     time_alarm = alarm.time.TimeAlarm(monotonic_time=wakeup_time)
 